@@ -0,0 +1,29 @@
+"""
+    Runs the benchmark suite, optionally saving the results as a baseline or comparing against one.
+"""
+
+import argparse
+
+from synacor.benchmark import BenchmarkSuite, WORKLOADS
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('workloads', nargs='*', help='any of: ' + ', '.join(name for name, _ in WORKLOADS))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per workload, the fastest is kept')
+    parser.add_argument('--jit', action='store_true', help='run the VM workloads on JitVm')
+    parser.add_argument('--fuse', action='store_true', help='fuse instruction sequences into superinstructions')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against the results in this JSON file')
+    args = parser.parse_args()
+
+    suite = BenchmarkSuite(args.workloads, repeat=args.repeat, jit=args.jit, fuse=args.fuse)
+    suite.run()
+
+    baseline = BenchmarkSuite.load_baseline(args.compare) if args.compare else None
+    print suite.report(baseline)
+
+    if args.save:
+        suite.save(args.save)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+    Recovers the functions, call graph and code and data ranges of an image by following its control flow.
+
+    usage: synacor-cfg.py [--cache] [image] [extra root ...], memdump.dat when no image is given
+
+    --cache keeps the graphs in .cfg-cache so the same image isn't analysed again on the next run
+"""
+
+import sys
+
+from synacor.vm import FileLoader
+from synacor.cfg import FlowAnalyzer
+
+CACHE_DIR = '.cfg-cache'
+
+def main():
+    arguments = sys.argv[1:]
+    cache_dir = None
+    if len(arguments) >= 1 and arguments[0] == '--cache':
+        cache_dir = CACHE_DIR
+        arguments = arguments[1:]
+
+    image = arguments[0] if len(arguments) >= 1 else 'memdump.dat'
+    roots = [0] + [int(root) for root in arguments[1:]]
+
+    graph = FlowAnalyzer(cache_dir=cache_dir).analyze(FileLoader.load(image), roots)
+
+    print '%s instructions in %s blocks and %s functions' % (len(graph.instructions), len(graph.blocks),
+                                                            len(graph.functions))
+    print
+
+    for entry in sorted(graph.functions):
+        calls = ', '.join('F%s' % target for target in sorted(graph.call_graph[entry]))
+        print 'F%-5s %4s blocks  calls: %s' % (entry, len(graph.functions[entry]), calls)
+
+    print
+    print 'unresolved jumps and calls through registers: %s' % ', '.join(str(a) for a in sorted(graph.indirect))
+    print 'code: %s' % ', '.join('%s-%s' % (start, end - 1) for start, end in graph.code_ranges())
+    print 'data: %s' % ', '.join('%s-%s' % (start, end - 1) for start, end in graph.data_ranges())
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,20 @@
 """
   Decompiles bin files into a series of instructions.
+
+  usage: synacor-decompiler.py [image], memdump.dat when no image is given
 """
 
-from synacor.vm import FileLoader, Decompiler
+import sys
+
+from synacor.vm import FileLoader
+from synacor.disassembler import BulkDecompiler
 
 def main():
-    data = FileLoader.load('memdump.dat')
-    decompiler = Decompiler()
-    decompiler.decompile(data)
+    image = sys.argv[1] if len(sys.argv) == 2 else 'memdump.dat'
+
+    data = FileLoader.load(image)
+    decompiler = BulkDecompiler()
+    decompiler.decompile(data, sys.stdout)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,32 @@
+"""
+    Explores the text adventure breadth first and reports the rooms, items and codes it finds.
+
+    usage: synacor-explorer.py [--fuse] [max depth]
+
+    --fuse has the VMs fuse common instruction sequences into superinstructions
+"""
+
+import sys
+
+from synacor.vm import FileLoader
+from synacor.explorer import Explorer
+
+def main():
+    data = FileLoader.load('challenge.bin')
+
+    arguments = sys.argv[1:]
+    fuse = len(arguments) >= 1 and arguments[0] == '--fuse'
+    if fuse:
+        arguments = arguments[1:]
+
+    max_depth = 20
+    if len(arguments) == 1:
+        max_depth = int(arguments[0])
+
+    explorer = Explorer(data, max_depth=max_depth, fuse=fuse)
+    explorer.explore()
+
+    print explorer.report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+    Runs the server against simulated clients in one process, every client plays the same script.
+
+    usage: synacor-loadtest.py clients script
+"""
+
+import sys
+import time
+import tempfile
+
+from synacor.vm import FileLoader
+from synacor.server import SessionServer, SimulatedClient
+
+def main():
+    if len(sys.argv) != 3:
+        print __doc__
+        return
+
+    clients = int(sys.argv[1])
+    script = open(sys.argv[2]).read().splitlines()
+
+    socket_map = {}
+    server = SessionServer(FileLoader.load('challenge.bin'), snapshot_dir=tempfile.mkdtemp(), map=socket_map)
+
+    started = time.time()
+    players = [SimulatedClient(server.address, script, socket_map) for _ in range(clients)]
+    server.serve_forever(until=lambda: all(player.done for player in players))
+    elapsed = time.time() - started
+
+    outputs = set(player.output() for player in players)
+
+    print "%s clients, %s commands each in %.2fs" % (clients, len(script), elapsed)
+    print "%s instructions, %.0f instructions/s" % (server.instruction_count, server.instruction_count / elapsed)
+    print "%s distinct transcripts" % len(outputs)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+    Plays a walkthrough script with the library routines the image is recognised to hold run natively, reporting which
+    were found and how long the script took. With --verify every native call is checked against the interpreted code,
+    with --fuse the rest of the code runs with common instruction sequences fused into superinstructions.
+
+    usage: synacor-natives.py script [--verify] [--fuse]
+"""
+
+import sys
+import time
+
+from synacor.vm import Vm, FileLoader
+from synacor.terminal import ScriptInput, CaptureSink
+from synacor.natives import library_registry
+
+def main():
+    if len(sys.argv) < 2:
+        print __doc__
+        return
+
+    verify = '--verify' in sys.argv[2:]
+    fuse = '--fuse' in sys.argv[2:]
+
+    vm = Vm(fuse=fuse)
+    vm.load(FileLoader.load('challenge.bin'))
+    vm.input_provider = ScriptInput(open(sys.argv[1]).read())
+    vm.output.sink = CaptureSink()
+
+    installed = library_registry().install(vm, verify=verify)
+    print 'native routines: %s' % (', '.join(installed) if installed else 'none recognised')
+
+    start = time.time()
+    vm.run()
+    print 'played in %.2fs' % (time.time() - start)
+
+    if verify:
+        for address, routine in sorted(vm.native_routines.items()):
+            print '%s at %s: %s calls verified' % (routine.name, address, routine.verified)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+    Lists the opcode sequences the challenge executes most while it plays a walkthrough script.
+
+    usage: synacor-ngrams.py script [n] [limit]
+"""
+
+import sys
+
+from synacor.vm import Vm, FileLoader
+from synacor.terminal import ScriptInput, CaptureSink
+from synacor.profiler import NgramCounter
+
+def main():
+    if len(sys.argv) < 2:
+        print __doc__
+        return
+
+    n = int(sys.argv[2]) if len(sys.argv) >= 3 else 2
+    limit = int(sys.argv[3]) if len(sys.argv) >= 4 else 20
+
+    vm = Vm()
+    vm.load(FileLoader.load('challenge.bin'))
+    vm.input_provider = ScriptInput(open(sys.argv[1]).read())
+    vm.output.sink = CaptureSink()
+
+    counter = NgramCounter(n)
+    counter.run(vm)
+
+    print counter.report(limit)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+    Profiles the challenge while it plays a walkthrough script.
+
+    usage: synacor-profile.py script [collapsed stacks file] [interval]
+
+    every instruction is profiled when interval is 1, the default, above that every interval-th is sampled, which is
+    much cheaper but only estimates everything but the call counts
+"""
+
+import sys
+
+from synacor.vm import Vm, FileLoader
+from synacor.terminal import ScriptInput, CaptureSink
+from synacor.profiler import Profiler
+
+def main():
+    if len(sys.argv) < 2:
+        print __doc__
+        return
+
+    interval = int(sys.argv[3]) if len(sys.argv) >= 4 else 1
+
+    vm = Vm()
+    vm.load(FileLoader.load('challenge.bin'))
+    vm.input_provider = ScriptInput(open(sys.argv[1]).read())
+    vm.output.sink = CaptureSink()
+
+    profiler = Profiler(interval=interval)
+    profiler.run(vm)
+
+    print profiler.report(vm.memory)
+
+    if len(sys.argv) >= 3:
+        profiler.save_collapsed(sys.argv[2])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+    Replays walkthrough scripts against the challenge without a terminal, one VM per script.
+
+    usage: synacor-replay.py [--fuse] script [script ...], the output of each script is written to <script>.out
+
+    --fuse has the VMs fuse common instruction sequences into superinstructions
+"""
+
+import sys
+
+from synacor.vm import Vm, FileLoader
+from synacor.terminal import ScriptInput, FileSink
+
+def main():
+    arguments = sys.argv[1:]
+    fuse = len(arguments) >= 1 and arguments[0] == '--fuse'
+    if fuse:
+        arguments = arguments[1:]
+
+    if len(arguments) < 1:
+        print __doc__
+        return
+
+    data = FileLoader.load('challenge.bin')
+
+    for script in arguments:
+        sink = FileSink(script + '.out')
+
+        vm = Vm(fuse=fuse)
+        vm.load(data)
+        vm.input_provider = ScriptInput(open(script).read())
+        vm.output.sink = sink
+        vm.run()
+
+        sink.close()
+
+        status = 'waiting for input' if vm.waiting_for_input else 'halted'
+        print "%s: %s at %s" % (script, status, vm.exec_ptr)
+
+if __name__ == "__main__":
+    main()
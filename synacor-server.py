@@ -0,0 +1,21 @@
+"""
+    Serves the challenge over TCP, one VM per connection.
+
+    usage: synacor-server.py [port] [snapshot directory]
+"""
+
+import sys
+
+from synacor.vm import FileLoader
+from synacor.server import SessionServer
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) >= 2 else 9999
+    snapshot_dir = sys.argv[2] if len(sys.argv) >= 3 else '.'
+
+    server = SessionServer(FileLoader.load('challenge.bin'), host='0.0.0.0', port=port, snapshot_dir=snapshot_dir)
+    print "Listening on %s:%s" % server.address
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""
+    Turns a binary spy log written by the debugger's spy command into "step:addr mnemonic" lines.
+
+    usage: synacor-spy.py log [address from] [address to] [registers]
+"""
+
+import sys
+
+from synacor.vm import MAX_MEMORY_ADDRESS
+from synacor.spylog import SpyLogReader
+
+def main():
+    if len(sys.argv) < 2:
+        print __doc__
+        return
+
+    address_from = int(sys.argv[2]) if len(sys.argv) >= 3 else 0
+    address_to = int(sys.argv[3]) if len(sys.argv) >= 4 else MAX_MEMORY_ADDRESS
+    registers = len(sys.argv) >= 5 and sys.argv[4] == 'registers'
+
+    reader = SpyLogReader(sys.argv[1])
+    for line in reader.lines(address_from, address_to, registers):
+        sys.stdout.write(line + '\n')
+
+if __name__ == "__main__":
+    main()
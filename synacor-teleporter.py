@@ -0,0 +1,23 @@
+"""
+    Searches for the values of the eighth register that the teleporter confirmation accepts.
+
+    Every candidate is evaluated at once with NumPy, pass --pool [processes] to instead run the memoized routine for
+    each candidate across a process pool.
+"""
+
+import sys
+
+from synacor.natives import EnergyLevelSolver, search_energy_levels
+
+def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == '--pool':
+        processes = int(sys.argv[2]) if len(sys.argv) == 3 else None
+        energy_levels = search_energy_levels(processes=processes)
+    else:
+        energy_levels = EnergyLevelSolver().solve()
+
+    for energy_level in energy_levels:
+        print energy_level
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""
+    Repeatable benchmarks for the VM and its tooling, every workload runs offline in a process of its own.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+
+from multiprocessing import Pool
+from StringIO import StringIO
+
+from vm import Vm, FileLoader, Decompiler, Snapshot, SET, PUSH, POP, EQ, GT, JMP, JT, JF, ADD, MULT, MOD, \
+    AND, OR, NOT, RMEM, WMEM, CALL, RET, OUT, IN, NOOP, HALT, REGISTER_0, REGISTER_1, REGISTER_2, REGISTER_3, \
+    REGISTER_4, REGISTER_6, REGISTER_7
+from jit import JitVm
+from disassembler import BulkDecompiler
+from terminal import ScriptInput, CaptureSink
+
+IMAGE = 'challenge.bin'
+MEMORY_DUMP = 'memdump.dat'
+WALKTHROUGH = 'walkthrough.txt'
+
+MICRO_ITERATIONS = 20000
+MICRO_UNROLL = 16
+MICRO_DATA_ADDRESS = 30000
+ROUND_TRIPS = 200
+
+# placeholders in the microbenchmark bodies, filled in once the program is laid out
+NEXT = 'next'
+SUBROUTINE = 'subroutine'
+
+MICROBENCHMARKS = [
+    ('set', [SET, REGISTER_0, REGISTER_1]),
+    ('push-pop', [PUSH, REGISTER_0, POP, REGISTER_0]),
+    ('eq', [EQ, REGISTER_0, REGISTER_1, REGISTER_2]),
+    ('gt', [GT, REGISTER_0, REGISTER_1, REGISTER_2]),
+    ('jmp', [JMP, NEXT]),
+    ('jt', [JT, REGISTER_6, 0]),
+    ('jf', [JF, REGISTER_7, 0]),
+    ('add', [ADD, REGISTER_0, REGISTER_0, 1]),
+    ('mult', [MULT, REGISTER_0, REGISTER_1, 3]),
+    ('mod', [MOD, REGISTER_0, REGISTER_1, 7]),
+    ('and', [AND, REGISTER_0, REGISTER_1, REGISTER_2]),
+    ('or', [OR, REGISTER_0, REGISTER_1, REGISTER_2]),
+    ('not', [NOT, REGISTER_0, REGISTER_1]),
+    ('rmem', [RMEM, REGISTER_0, MICRO_DATA_ADDRESS]),
+    ('wmem', [WMEM, MICRO_DATA_ADDRESS, REGISTER_0]),
+    ('call-ret', [CALL, SUBROUTINE]),
+    ('out', [OUT, 65]),
+    ('in', [IN, REGISTER_0]),
+    ('noop', [NOOP]),
+]
+
+
+def build_microbenchmark(body, iterations=MICRO_ITERATIONS, unroll=MICRO_UNROLL):
+    """ Lay out a program that runs body unroll times per iteration of a loop counted down in @7:
+
+        set @7, iterations
+        loop: body * unroll
+        add @7, @7, 32767
+        jt @7, loop
+        halt
+        subroutine: ret
+
+    :param list body: The words of the instructions to benchmark, NEXT and SUBROUTINE are filled in
+    :returns list
+    """
+    loop = 3
+    end = loop + len(body) * unroll
+    subroutine = end + 4 + 3 + 1
+
+    words = [SET, REGISTER_7, iterations]
+    for _ in range(unroll):
+        start = len(words)
+        words += [start + len(body) if word == NEXT else subroutine if word == SUBROUTINE else word for word in body]
+
+    words += [ADD, REGISTER_7, REGISTER_7, 32767, JT, REGISTER_7, loop, HALT, RET]
+
+    return words
+
+
+def new_vm(jit, fuse=False):
+    vm = JitVm(fuse=fuse) if jit else Vm(fuse=fuse)
+    vm.input_provider = None
+    vm.output.sink = CaptureSink()
+
+    return vm
+
+
+def timed(function):
+    started = time.time()
+    result = function()
+    return result, time.time() - started
+
+
+def run_vm_workload(jit, fuse, prepare):
+    """ Time a VM from prepare running until it halts or waits for input. Every mode is timed through run, the way it
+    runs outside of the benchmarks, and the instructions are counted by a separate Vm.run_until pass that isn't timed.
+    :param bool jit: Time JitVm instead of Vm
+    :param bool fuse: Have the VM fuse instruction sequences
+    :param prepare: callable(vm) that loads the program and input
+    :returns dict
+    """
+    vm = new_vm(jit, fuse)
+    prepare(vm)
+
+    _, wall = timed(vm.run)
+
+    counter = new_vm(False)
+    prepare(counter)
+    counter.run_until(None)
+
+    return {'instructions': counter.last_executed, 'wall': wall, 'halted': not vm.waiting_for_input}
+
+
+def workload_self_test(jit, fuse):
+    """ challenge.bin from power on to its first prompt
+    """
+    def prepare(vm):
+        vm.load(FileLoader.load(IMAGE))
+
+    return run_vm_workload(jit, fuse, prepare)
+
+
+def workload_walkthrough(jit, fuse):
+    """ challenge.bin played through walkthrough.txt up to using the teleporter
+    """
+    def prepare(vm):
+        vm.load(FileLoader.load(IMAGE))
+        vm.input_provider = ScriptInput(open(WALKTHROUGH).read())
+
+    return run_vm_workload(jit, fuse, prepare)
+
+
+def microbenchmark_workload(name, body):
+    def prepare(vm):
+        vm.load(build_microbenchmark(body))
+        if name == 'in':
+            vm.feed_input('x' * (MICRO_ITERATIONS * MICRO_UNROLL))
+
+    def workload(jit, fuse):
+        result = run_vm_workload(jit, fuse, prepare)
+        if not result['halted']:
+            raise RuntimeError("Microbenchmark %s stopped before halting" % name)
+
+        return result
+
+    workload.__doc__ = """ %s, %s times per iteration
+    """ % (name, MICRO_UNROLL)
+
+    return workload
+
+
+def workload_decompile(jit, fuse):
+    """ Decompiler.decompile over memdump.dat
+    """
+    data = FileLoader.load(MEMORY_DUMP)
+    decompiler = Decompiler()
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        _, wall = timed(lambda: decompiler.decompile(data))
+    finally:
+        sys.stdout = stdout
+
+    return {'instructions': decompiler.line, 'wall': wall}
+
+
+def workload_decompile_bulk(jit, fuse):
+    """ BulkDecompiler.decompile over memdump.dat
+    """
+    data = FileLoader.load(MEMORY_DUMP)
+    output = StringIO()
+
+    _, wall = timed(lambda: BulkDecompiler().decompile(data, output))
+
+    return {'instructions': output.getvalue().count('\n'), 'wall': wall}
+
+
+def workload_snapshot(jit, fuse):
+    """ Snapshot dumps and loads of a VM at the first prompt
+    """
+    vm = new_vm(jit, fuse)
+    vm.load(FileLoader.load(IMAGE))
+    vm.run_until(None)
+    restored = new_vm(jit, fuse)
+
+    def round_trips():
+        for _ in range(ROUND_TRIPS):
+            Snapshot.loads(Snapshot.dumps(vm), restored)
+
+    _, wall = timed(round_trips)
+
+    return {'instructions': 0, 'wall': wall}
+
+
+def workload_file_loader(jit, fuse):
+    """ FileLoader save and load of challenge.bin, read and mapped
+    """
+    directory = tempfile.mkdtemp()
+    copy = os.path.join(directory, 'image.bin')
+    data = FileLoader.load(IMAGE)
+
+    def round_trips():
+        for _ in range(ROUND_TRIPS):
+            FileLoader.save(data, copy)
+            FileLoader.load(copy)
+            mapped = FileLoader.load(copy, mapped=True)
+            mapped[0] = mapped[0]
+            FileLoader.save(mapped, copy)
+
+    try:
+        _, wall = timed(round_trips)
+    finally:
+        shutil.rmtree(directory)
+
+    return {'instructions': 0, 'wall': wall}
+
+
+def build_fusion_checks():
+    """ Lay out programs that jump into the middle of fused sequences and write into them past the words decoding
+    alone would drop, every superinstruction decode_fused makes has to give way to the instructions it was fused from:
+
+        out 'a', out 'b', out 'c', out '\\n'      the out run is entered at its start, at 'b' and after 'c' has been
+        add @0, @0, 1                            rewritten to 'X'
+        eq @1, @0, 1
+        jt @1, 2
+        eq @1, @0, 2
+        jf @1, end
+        wmem 5, 'X'
+        jmp 0
+        end: halt
+
+        push 7, push 8, push 9                   the push run is entered at its start, at push 8 and after push 9 has
+        pop @0, pop @1                           been rewritten to push 5
+        add @3, @3, 1
+        eq @4, @3, 1
+        jt @4, 2
+        eq @4, @3, 2
+        jf @4, end
+        wmem 5, 5
+        jmp 0
+        end: halt
+
+    :returns list of (name, words)
+    """
+    out_run = [OUT, 97, OUT, 98, OUT, 99, OUT, 10,
+               ADD, REGISTER_0, REGISTER_0, 1, EQ, REGISTER_1, REGISTER_0, 1, JT, REGISTER_1, 2,
+               EQ, REGISTER_1, REGISTER_0, 2, JF, REGISTER_1, 31, WMEM, 5, 88, JMP, 0, HALT]
+    push_pop_run = [PUSH, 7, PUSH, 8, PUSH, 9, POP, REGISTER_0, POP, REGISTER_1,
+                    ADD, REGISTER_3, REGISTER_3, 1, EQ, REGISTER_4, REGISTER_3, 1, JT, REGISTER_4, 2,
+                    EQ, REGISTER_4, REGISTER_3, 2, JF, REGISTER_4, 33, WMEM, 5, 5, JMP, 0, HALT]
+
+    return [('out-run', out_run), ('push-pop-run', push_pop_run)]
+
+
+def workload_fusion_check(jit, fuse):
+    """ Programs that jump into and rewrite fused sequences, run fused and checked against a plain Vm
+    """
+    instructions = 0
+    wall = 0
+
+    for name, words in build_fusion_checks():
+        expected = new_vm(False)
+        expected.load(list(words))
+        expected.run_until(None)
+        expected.output.flush()
+
+        vm = new_vm(jit, True)
+        vm.load(list(words))
+        _, elapsed = timed(vm.run)
+        vm.output.flush()
+
+        state = lambda machine: (machine.exec_ptr, list(machine.registers), list(machine.stack),
+                                 machine.output.sink.getvalue())
+        if state(vm) != state(expected):
+            raise RuntimeError("Fusion check %s ended in %r instead of %r" % (name, state(vm), state(expected)))
+
+        instructions += expected.last_executed
+        wall += elapsed
+
+    return {'instructions': instructions, 'wall': wall}
+
+
+WORKLOADS = [('self-test', workload_self_test), ('walkthrough', workload_walkthrough)] + \
+    [('micro-' + name, microbenchmark_workload(name, body)) for name, body in MICROBENCHMARKS] + \
+    [('decompile', workload_decompile), ('decompile-bulk', workload_decompile_bulk), ('snapshot', workload_snapshot),
+     ('file-loader', workload_file_loader), ('fusion-check', workload_fusion_check)]
+
+WORKLOAD_MAP = dict(WORKLOADS)
+
+
+def run_workload(task):
+    """ Pool worker, runs one workload and measures the memory it took on top of what the process started with
+    :param tuple task: (name, jit, fuse)
+    :returns dict
+    """
+    name, jit, fuse = task
+    start_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result = WORKLOAD_MAP[name](jit, fuse)
+
+    result['peak_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['growth_kb'] = result['peak_kb'] - start_kb
+
+    return result
+
+
+class BenchmarkSuite(object):
+    """ Runs workloads, each repeat in a fresh process so peak memory is per workload, keeping the fastest repeat
+    """
+
+    def __init__(self, names=None, repeat=3, jit=False, fuse=False):
+        """
+        :param list names: The workloads to run, all of them when None
+        :param int repeat: How often to run each workload
+        :param bool jit: Run the VM workloads on JitVm instead of Vm
+        :param bool fuse: Have the VM workloads fuse instruction sequences into superinstructions
+        """
+        self.names = names if names else [name for name, _ in WORKLOADS]
+        self.repeat = repeat
+        self.jit = jit
+        self.fuse = fuse
+        self.results = {}
+
+        for name in self.names:
+            if name not in WORKLOAD_MAP:
+                raise ValueError("Unknown workload: " + name)
+
+    def run(self):
+        """ Run every workload
+        :returns dict name -> result
+        """
+        for name in self.names:
+            best = None
+            for _ in range(self.repeat):
+                pool = Pool(1)
+                try:
+                    result = pool.apply(run_workload, ((name, self.jit, self.fuse),))
+                finally:
+                    pool.close()
+                    pool.join()
+
+                if best is None or result['wall'] < best['wall']:
+                    best = result
+
+            if best['instructions'] > 0:
+                best['instructions_per_second'] = best['instructions'] / best['wall']
+            self.results[name] = best
+
+        return self.results
+
+    def as_json(self):
+        return {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'vm': 'JitVm' if self.jit else 'Vm',
+            'fuse': self.fuse,
+            'results': self.results,
+        }
+
+    def save(self, file):
+        with open(file, 'w') as fh:
+            json.dump(self.as_json(), fh, indent=2, sort_keys=True)
+
+    def report(self, baseline=None):
+        """ A table of the results, with the change in wall time against baseline when given
+        :param dict baseline: The JSON of an earlier suite
+        :returns str
+        """
+        previous = baseline['results'] if baseline is not None else {}
+        lines = ['%-16s %10s %14s %12s %10s %10s' % ('workload', 'wall (s)', 'instructions', 'instr/s', 'peak kb',
+                                                     'change')]
+
+        for name in self.names:
+            result = self.results[name]
+            change = ''
+            if name in previous and previous[name]['wall'] > 0:
+                change = '%+.1f%%' % ((result['wall'] / previous[name]['wall'] - 1) * 100)
+
+            lines.append('%-16s %10.4f %14s %12.0f %10s %10s' % (name, result['wall'], result['instructions'],
+                                                                 result.get('instructions_per_second', 0),
+                                                                 result['peak_kb'], change))
+
+        return '\n'.join(lines)
+
+    @staticmethod
+    def load_baseline(file):
+        with open(file) as fh:
+            return json.load(fh)
@@ -0,0 +1,347 @@
+"""
+    Recursive descent disassembly of memory images into basic blocks, a control flow graph and a call graph.
+"""
+
+import os
+import copy
+import hashlib
+import cPickle as pickle
+
+import numpy
+
+from vm import HALT, SET, JMP, JT, JF, CALL, RET, MAX_INT, REGISTER_WRITERS
+from disassembler import BulkDecompiler
+
+# instructions that end a basic block
+BLOCK_TERMINATORS = frozenset([HALT, JMP, JT, JF, RET])
+
+# how far an instruction can reach back over a changed word, the longest one is 4 words
+MAX_INSTRUCTION_LENGTH = 4
+
+
+class BasicBlock(object):
+    """ A straight run of instructions entered only at its start
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.instructions = []
+        self.successors = []
+        self.calls = []
+
+    def __repr__(self):
+        return 'BasicBlock(%s-%s -> %s)' % (self.start, self.end, self.successors)
+
+
+class ControlFlowGraph(object):
+    """ Everything recovered from an image by following the control flow from a set of roots. Instructions are stored
+    as address -> (opcode, operands, length), words that no instruction covers are data.
+    """
+
+    def __init__(self, length, roots):
+        """
+        :param int length: The number of words in the image
+        :param tuple roots: The addresses the descent started from
+        """
+        self.length = length
+        self.roots = roots
+        self.instructions = {}
+        self.invalid = set()
+        self.leaders = set()
+        self.entries = set()
+        self.indirect = set()
+        self.targets = {}
+        self.blocks = {}
+        self.functions = {}
+        self.call_graph = {}
+
+    def code_mask(self):
+        """ Which words are covered by a recovered instruction
+        :returns numpy.ndarray of bool
+        """
+        mask = numpy.zeros(self.length, dtype=bool)
+        for address, (_, _, length) in self.instructions.iteritems():
+            mask[address:address + length] = True
+
+        return mask
+
+    def read_mask(self):
+        """ Every word the descent looked at, a change to any other word can't change the graph
+        :returns numpy.ndarray of bool
+        """
+        mask = self.code_mask()
+        for address in self.invalid:
+            # telling an instruction is invalid can take the word after it
+            mask[address:address + 2] = True
+
+        return mask
+
+    def data_ranges(self):
+        """ The runs of words no recovered instruction covers
+        :returns list of (start, end) with end exclusive
+        """
+        return ControlFlowGraph.ranges(~self.code_mask())
+
+    def code_ranges(self):
+        """ The runs of words covered by recovered instructions
+        :returns list of (start, end) with end exclusive
+        """
+        return ControlFlowGraph.ranges(self.code_mask())
+
+    def functions_containing(self, address):
+        """ The entries of every function with a block holding address
+        :returns list
+        """
+        return sorted(entry for entry, starts in self.functions.iteritems()
+                      if any(self.blocks[start].start <= address < self.blocks[start].end for start in starts))
+
+    @staticmethod
+    def ranges(mask):
+        """ The runs of True in mask
+        :returns list of (start, end) with end exclusive
+        """
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], mask.astype(numpy.int8), [0]))))
+        return zip(edges[0::2].tolist(), edges[1::2].tolist())
+
+
+class FlowAnalyzer(object):
+    """ Builds control flow graphs, caching them by a hash of the image and the roots, in memory and optionally on
+    disk. After a small patch the graph of the last image analysed is reused outright when the patch only touches words
+    the descent never read, otherwise only the classification of the patched words is redone before descending again.
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        :param str cache_dir: Where to pickle graphs between runs, memory only when None
+        """
+        self.cache_dir = cache_dir
+        self.cache = {}
+        self.previous = None
+
+    def analyze(self, data, roots=(0,)):
+        """ The control flow graph of data
+        :param data: The image, anything numpy.asarray turns into words
+        :param roots: The addresses to descend from, the entry point and any known callbacks
+        :returns ControlFlowGraph
+        """
+        words = numpy.array(data, dtype=numpy.uint16)
+        roots = tuple(sorted(set(roots)))
+        key = FlowAnalyzer.key(words, roots)
+
+        graph = self.load(key)
+        if graph is None:
+            graph = self.analyze_patched(words, roots)
+            if graph is None:
+                lengths, decodes = BulkDecompiler.classify(words)
+                graph = FlowAnalyzer.descend(words, lengths, decodes, roots)
+            self.store(key, graph)
+
+        self.previous = (words, roots, graph)
+
+        return graph
+
+    def analyze_patched(self, words, roots):
+        """ Analyse words as a patch of the last image analysed with the same roots, None when it isn't one
+        """
+        if self.previous is None:
+            return None
+
+        previous_words, previous_roots, previous_graph = self.previous
+        if previous_roots != roots or len(previous_words) != len(words):
+            return None
+
+        changed = numpy.flatnonzero(previous_words != words)
+        lengths, decodes = FlowAnalyzer.reclassify(words, previous_graph.classification, changed)
+
+        if not previous_graph.read_mask()[changed].any():
+            # same graph, but a later patch that reaches the changed words has to see them classified as they are now
+            graph = copy.copy(previous_graph)
+            graph.classification = (lengths, decodes)
+            return graph
+
+        return FlowAnalyzer.descend(words, lengths, decodes, roots)
+
+    @staticmethod
+    def reclassify(words, classification, changed):
+        """ A copy of classification with only the words that can see a change classified again
+        :param numpy.ndarray words: The patched image
+        :param tuple classification: (lengths, decodes) of the image before the patch
+        :param numpy.ndarray changed: The addresses of the patched words
+        :returns tuple (lengths, decodes)
+        """
+        lengths, decodes = classification
+        lengths = lengths.copy()
+        decodes = decodes.copy()
+        for address in changed.tolist():
+            start = max(address - MAX_INSTRUCTION_LENGTH + 1, 0)
+            window_lengths, window_decodes = BulkDecompiler.classify(words[start:address + MAX_INSTRUCTION_LENGTH])
+            end = min(address + 1, len(words))
+            # the window is cut short, only trust it up to the changed word
+            lengths[start:end] = window_lengths[:end - start]
+            decodes[start:end] = window_decodes[:end - start]
+
+        return lengths, decodes
+
+    @staticmethod
+    def descend(words, lengths, decodes, roots):
+        """ Recursive descent from roots followed by splitting the instructions found into basic blocks
+        :returns ControlFlowGraph
+        """
+        graph = ControlFlowGraph(len(words), roots)
+        graph.classification = (lengths, decodes)
+
+        FlowAnalyzer.find_instructions(graph, words.tolist(), lengths.tolist(), decodes.tolist())
+        FlowAnalyzer.build_blocks(graph)
+        FlowAnalyzer.build_functions(graph)
+
+        return graph
+
+    @staticmethod
+    def find_instructions(graph, words, lengths, decodes):
+        """ Follow every path from the roots. Jumps and calls through a register are resolved when a SET earlier on the
+        same straight path loaded it with a literal, which is how the image calls through registers.
+        """
+        instructions = graph.instructions
+        graph.targets = {}
+        pending = [(root, {}) for root in graph.roots]
+        graph.leaders.update(graph.roots)
+        graph.entries.update(graph.roots)
+
+        while pending:
+            address, constants = pending.pop()
+
+            while address not in instructions and address not in graph.invalid:
+                if address >= len(words) or not decodes[address]:
+                    graph.invalid.add(address)
+                    break
+
+                length = lengths[address]
+                opcode = words[address]
+                operands = tuple(words[address + 1:address + length])
+                instructions[address] = (opcode, operands, length)
+                next_ptr = address + length
+
+                if opcode == JMP or opcode == JT or opcode == JF or opcode == CALL:
+                    target = constants.get(operands[-1]) if operands[-1] >= MAX_INT else operands[-1]
+                    if target is None:
+                        graph.indirect.add(address)
+                    else:
+                        graph.targets[address] = target
+                        graph.leaders.add(target)
+                        pending.append((target, {}))
+
+                        if opcode == CALL:
+                            graph.entries.add(target)
+
+                    if opcode == JMP:
+                        break
+                    elif opcode == CALL:
+                        # the callee can leave anything in the registers
+                        constants = {}
+                    else:
+                        graph.leaders.add(next_ptr)
+                elif opcode == RET or opcode == HALT:
+                    break
+                elif opcode in REGISTER_WRITERS:
+                    constants = dict(constants)
+                    if opcode == SET and operands[1] < MAX_INT:
+                        constants[operands[0]] = operands[1]
+                    else:
+                        constants.pop(operands[0], None)
+
+                address = next_ptr
+
+    @staticmethod
+    def build_blocks(graph):
+        instructions = graph.instructions
+
+        for leader in graph.leaders:
+            if leader not in instructions:
+                continue
+
+            block = BasicBlock(leader)
+            address = leader
+
+            while True:
+                opcode, operands, length = instructions[address]
+                block.instructions.append((address, opcode, operands))
+                next_ptr = address + length
+
+                target = graph.targets.get(address)
+
+                if opcode == CALL and target is not None:
+                    block.calls.append(target)
+
+                if opcode in BLOCK_TERMINATORS:
+                    if opcode in (JMP, JT, JF) and target is not None:
+                        block.successors.append(target)
+                    if opcode in (JT, JF):
+                        block.successors.append(next_ptr)
+                    break
+
+                if next_ptr in graph.leaders:
+                    block.successors.append(next_ptr)
+                    break
+
+                if next_ptr not in instructions:
+                    # runs into something that doesn't decode
+                    break
+
+                address = next_ptr
+
+            block.end = next_ptr
+            graph.blocks[leader] = block
+
+    @staticmethod
+    def build_functions(graph):
+        """ A function is every block reachable from a call target or root without following calls
+        """
+        for entry in graph.entries:
+            if entry not in graph.blocks:
+                continue
+
+            seen = set([entry])
+            pending = [entry]
+            calls = set()
+
+            while pending:
+                block = graph.blocks[pending.pop()]
+                calls.update(block.calls)
+                for successor in block.successors:
+                    if successor not in seen and successor in graph.blocks:
+                        seen.add(successor)
+                        pending.append(successor)
+
+            graph.functions[entry] = seen
+            graph.call_graph[entry] = calls
+
+    @staticmethod
+    def key(words, roots):
+        digest = hashlib.sha1(words.tostring())
+        digest.update(repr(roots))
+        return digest.hexdigest()
+
+    def load(self, key):
+        if key in self.cache:
+            return self.cache[key]
+
+        if self.cache_dir is not None:
+            file = os.path.join(self.cache_dir, key + '.cfg')
+            if os.path.exists(file):
+                with open(file, 'rb') as fh:
+                    graph = pickle.load(fh)
+                self.cache[key] = graph
+                return graph
+
+        return None
+
+    def store(self, key, graph):
+        self.cache[key] = graph
+
+        if self.cache_dir is not None:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            with open(os.path.join(self.cache_dir, key + '.cfg'), 'wb') as fh:
+                pickle.dump(graph, fh, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,303 @@
+"""
+    Bulk disassembly of whole memory images, classifying every word at once with NumPy lookup tables.
+"""
+
+import numpy
+
+from vm import Decompiler, INSTRUCTIONS, POP, NOT, SET, RMEM, REGISTER_0, REGISTER_7
+
+WORD_VALUES = 1 << 16
+
+# operands per opcode as the linear Decompiler reads them, -1 for words that aren't instructions
+OPERAND_COUNTS = numpy.full(WORD_VALUES, -1, dtype=numpy.int8)
+for opcodes, count in ((Decompiler.ZERO_OPTS, 0), (Decompiler.ONE_OPTS + [POP], 1),
+                       (Decompiler.TWO_OPTS + [NOT, SET, RMEM], 2), (Decompiler.THREE_OPTS, 3)):
+    OPERAND_COUNTS[opcodes] = count
+
+# opcodes that only decode when their first operand is a register
+NEEDS_REGISTER = numpy.zeros(WORD_VALUES, dtype=bool)
+NEEDS_REGISTER[[POP, NOT, SET, RMEM] + Decompiler.THREE_OPTS] = True
+
+RECORD_TYPE = numpy.dtype([
+    ('offset', numpy.int32),
+    ('opcode', numpy.uint16),
+    ('length', numpy.uint8),
+    ('instruction', bool),
+    ('a', numpy.uint16),
+    ('b', numpy.uint16),
+    ('c', numpy.uint16),
+])
+
+
+class BulkDecompiler(object):
+    """ Produces the same listing as Decompiler.decompile without walking memory through Python one word at a time. The
+    length of an instruction at every address is worked out at once with lookup tables, the linear sweep then only
+    steps through a list of those lengths and the records are gathered into a preallocated structured array.
+
+    One difference: an instruction whose operands would run past the end of the image is listed as a raw word instead
+    of raising.
+    """
+
+    def __init__(self):
+        self._arguments = None
+
+    @property
+    def arguments(self):
+        """ The text of every possible operand word, built on first use
+        """
+        if self._arguments is None:
+            decompiler = Decompiler()
+            self._arguments = [decompiler.parse_argument(value) for value in xrange(WORD_VALUES)]
+        return self._arguments
+
+    @staticmethod
+    def classify(words):
+        """ Work out at every address whether an instruction decodes there and how long it, or the raw word, is
+        :param numpy.ndarray words: The image as uint16
+        :returns tuple (lengths, decodes) of numpy arrays
+        """
+        padded = numpy.zeros(len(words) + 3, dtype=numpy.uint16)
+        padded[:len(words)] = words
+        first = padded[1:len(words) + 1]
+
+        counts = OPERAND_COUNTS[words]
+        is_register = (first >= REGISTER_0) & (first <= REGISTER_7)
+        decodes = (counts >= 0) & (~NEEDS_REGISTER[words] | is_register)
+
+        lengths = numpy.where(decodes, counts + 1, 1).astype(numpy.int32)
+
+        # operands running past the end make it a raw word
+        overrun = numpy.arange(len(words)) + lengths > len(words)
+        lengths[overrun] = 1
+        decodes &= ~overrun
+
+        return lengths, decodes
+
+    @staticmethod
+    def lengths(words):
+        """ The length of the instruction, or raw word, at every address
+        :param numpy.ndarray words: The image as uint16
+        :returns numpy.ndarray
+        """
+        return BulkDecompiler.classify(words)[0]
+
+    def records(self, data):
+        """ Sweep the image from its first word the way Decompiler.decompile does
+        :param data: The image, anything numpy.asarray turns into words
+        :returns numpy.ndarray of RECORD_TYPE, one per listed line
+        """
+        words = numpy.asarray(data, dtype=numpy.uint16)
+        lengths = BulkDecompiler.lengths(words)
+
+        step = lengths.tolist()
+        offsets = []
+        offset = 0
+        while offset < len(step):
+            offsets.append(offset)
+            offset += step[offset]
+
+        offsets = numpy.array(offsets, dtype=numpy.int32)
+        padded = numpy.zeros(len(words) + 3, dtype=numpy.uint16)
+        padded[:len(words)] = words
+
+        records = numpy.zeros(len(offsets), dtype=RECORD_TYPE)
+        records['offset'] = offsets
+        records['opcode'] = words[offsets]
+        records['length'] = lengths[offsets]
+        records['instruction'] = (OPERAND_COUNTS[records['opcode']] + 1 == records['length'])
+        for index, field in enumerate(('a', 'b', 'c')):
+            has_operand = records['instruction'] & (records['length'] > index + 1)
+            records[field] = numpy.where(has_operand, padded[offsets + index + 1], 0)
+
+        return records
+
+    def instructions(self, data, records=None):
+        """ Generator over the listing without building its text
+        :param data: The image
+        :param records: Records from records, worked out from data when None
+        :returns generator of (offset, name, operands), name is None and operands the raw word for non-instructions
+        """
+        if records is None:
+            records = self.records(data)
+
+        for offset, opcode, length, instruction, a, b, c in records.tolist():
+            if instruction:
+                yield offset, INSTRUCTIONS[opcode], (a, b, c)[:length - 1]
+            else:
+                yield offset, None, (opcode,)
+
+    def lines(self, data, records=None):
+        """ Generator over the lines of the listing, as Decompiler.decompile prints them
+        :param data: The image
+        :param records: Records from records, worked out from data when None
+        """
+        arguments = self.arguments
+
+        for line, (offset, name, operands) in enumerate(self.instructions(data, records)):
+            if name is None:
+                text = str(operands[0])
+            else:
+                text = name + " " + ", ".join([arguments[operand] for operand in operands])
+
+            yield "[%05d:%05d]: %s" % (line, offset, text)
+
+    def decompile(self, data, file):
+        """ Write the listing of data to file in one write
+        :param data: The image
+        :param file: An open file
+        """
+        file.write("\n".join(self.lines(data)) + "\n")
+
+
+class LiveListing(object):
+    """ The listing of a VM's memory kept up to date as the program rewrites itself. The VM reports every word written
+    through wmem or write_memory and only the part of the sweep that can see those words is redone the next time the
+    listing is asked for, picking the old sweep back up at the first instruction boundary past them. Swapping the VM's
+    memory for another, as load and restoring a snapshot do, rebuilds the whole listing.
+    """
+
+    # the widest an instruction is, so the furthest back a change to a word can be seen from
+    MAX_LENGTH = 4
+
+    def __init__(self, vm):
+        """
+        :param Vm vm: The VM whose memory to follow, attached to straight away
+        """
+        self.vm = vm
+        self.memory = None
+        self.bodies = None
+        self.lengths = None
+        self.dirty = set()
+        self.redecoded = 0
+        self._text = None
+
+        self.counts = OPERAND_COUNTS.tolist()
+        self.needs_register = NEEDS_REGISTER.tolist()
+        self.arguments = BulkDecompiler().arguments
+
+        self.attach()
+
+    def attach(self):
+        self.vm.listing = self
+
+    def detach(self):
+        if self.vm.listing is self:
+            self.vm.listing = None
+
+    def mark(self, address):
+        """ Note that the word at address was written to
+        :param int address: The memory address written to
+        """
+        self.dirty.add(address)
+
+    def rebuild(self):
+        """ Sweep the whole of memory again
+        """
+        memory = self.vm.memory
+        words = numpy.array(list(memory), dtype=numpy.uint16)
+
+        self.bodies = [None] * len(words)
+        self.lengths = [0] * len(words)
+        for offset, name, operands in BulkDecompiler().instructions(words):
+            self.store(offset, name, operands)
+
+        self.memory = memory
+        self.dirty = set()
+        self._text = None
+
+    def refresh(self):
+        """ Redo the sweep over every word written since the last refresh
+        :returns int the number of records decoded again
+        """
+        if self.memory is not self.vm.memory:
+            self.rebuild()
+            return len(self.bodies)
+
+        if len(self.dirty) == 0:
+            return 0
+
+        dirty = sorted(self.dirty)
+        self.dirty = set()
+        self._text = None
+
+        redecoded = 0
+        last = -1
+        for address in dirty:
+            if address <= last:
+                # already swept over by the change before it
+                continue
+
+            # a raw word depends on the word after it, so start at the record that holds the word before the change
+            offset = max(address - 1, 0)
+            while self.bodies[offset] is None:
+                offset -= 1
+
+            # stop at the first old boundary past the change, everything from there on is the same as before
+            while offset < len(self.bodies) and (offset <= address or self.bodies[offset] is None):
+                offset = self.decode(offset)
+                redecoded += 1
+
+            last = offset - 1
+
+        self.redecoded += redecoded
+
+        return redecoded
+
+    def decode(self, offset):
+        """ Decode the record at offset the way BulkDecompiler classifies it, dropping any old record it now covers
+        :returns int the offset of the next record
+        """
+        memory = self.memory
+        size = len(self.bodies)
+        opcode = memory[offset]
+
+        count = self.counts[opcode]
+        if count > 0 and self.needs_register[opcode]:
+            if offset + 1 >= size or not REGISTER_0 <= memory[offset + 1] <= REGISTER_7:
+                count = -1
+        if count >= 0 and offset + count >= size:
+            count = -1
+
+        length = count + 1 if count >= 0 else 1
+        for covered in range(offset + 1, offset + length):
+            self.bodies[covered] = None
+            self.lengths[covered] = 0
+
+        if count >= 0:
+            self.store(offset, INSTRUCTIONS[opcode], [memory[offset + index] for index in range(1, length)])
+        else:
+            self.store(offset, None, (opcode,))
+
+        return offset + length
+
+    def store(self, offset, name, operands):
+        if name is None:
+            self.bodies[offset] = "%05d]: %s" % (offset, operands[0])
+            self.lengths[offset] = 1
+        else:
+            arguments = self.arguments
+            self.bodies[offset] = "%05d]: %s %s" % (offset, name,
+                                                    ", ".join([arguments[operand] for operand in operands]))
+            self.lengths[offset] = len(operands) + 1
+
+    def lines(self):
+        """ The lines of the listing as BulkDecompiler.lines gives them for the memory as it is now
+        :returns list
+        """
+        self.refresh()
+
+        bodies = [body for body in self.bodies if body is not None]
+        return ["[%05d:%s" % (line, body) for line, body in enumerate(bodies)]
+
+    def text(self):
+        """ The whole listing as BulkDecompiler.decompile writes it, only put together again after a change
+        :returns str
+        """
+        if self.refresh() > 0 or self._text is None:
+            self._text = "\n".join(self.lines()) + "\n"
+
+        return self._text
+
+    def save(self, file):
+        with open(file, 'w') as fh:
+            fh.write(self.text())
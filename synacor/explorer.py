@@ -0,0 +1,235 @@
+"""
+    Breadth first explorer for the text adventure, it drives VMs with scripted input across a pool of processes.
+"""
+
+import re
+
+from multiprocessing import Pool
+
+from vm import Vm, Snapshot
+from terminal import CaptureSink
+
+ROOM_PATTERN = re.compile(r'^== (.+) ==\n(.*?)\n\n', re.MULTILINE | re.DOTALL)
+LIST_PATTERN = re.compile(r'^(Things of interest here|There (?:are \d+ exits|is 1 exit)):\n((?:- .+\n)+)', re.MULTILINE)
+CODE_PATTERN = re.compile(r'\b(?=[A-Za-z]*[a-z])(?=[A-Za-z]*[A-Z][A-Za-z]*[A-Z])[A-Za-z]{12}\b')
+
+
+def run_to_prompt(vm):
+    """ Run vm until it waits for input or halts, returning everything it wrote out
+    :param Vm vm: A VM without an input provider
+    :returns str
+    """
+    sink = CaptureSink()
+    vm.output.sink = sink
+    vm.run()
+
+    return sink.getvalue()
+
+
+def expand(task):
+    """ Pool worker, restores a state, enters one command and runs to the next prompt
+    :param tuple task: (snapshot, command, fuse)
+    :returns tuple (snapshot, digest, output, halted)
+    """
+    snapshot, command, fuse = task
+
+    vm = Vm(compact=True, fuse=fuse)
+    vm.input_provider = None
+    Snapshot.loads(snapshot, vm)
+    vm.feed_input(command + '\n')
+
+    output = run_to_prompt(vm)
+
+    return Snapshot.dumps(vm), vm.state_digest(), output, not vm.waiting_for_input
+
+
+class State(object):
+    """ A game state waiting at a prompt along with how it was reached
+    """
+
+    def __init__(self, snapshot, path, room, description, inventory):
+        """
+        :param str snapshot: The Snapshot of the VM waiting at the prompt
+        :param list path: The commands that lead here from the first prompt
+        :param str room: The name of the room in the graph
+        :param str description: The output that last described the room
+        :param frozenset inventory: The items taken along the way
+        """
+        self.snapshot = snapshot
+        self.path = path
+        self.room = room
+        self.description = description
+        self.inventory = inventory
+
+    def commands(self, verbs=('take', 'use')):
+        """ The candidate commands for this state: every exit, taking every item here and using every item held
+        """
+        things, exits = Explorer.parse_lists(self.description)
+
+        commands = list(exits)
+        if 'take' in verbs:
+            commands += ['take ' + thing for thing in things]
+        if 'use' in verbs:
+            commands += ['use ' + item for item in sorted(self.inventory)]
+
+        return commands
+
+
+class Explorer(object):
+    """ Explores the game breadth first from the first prompt of an image. States are deduplicated on a hash of memory,
+    registers and stack, each level of the search is spread across a multiprocessing pool.
+    """
+
+    def __init__(self, data, processes=None, max_depth=20, max_states=10000, verbs=('take', 'use'), fuse=False):
+        """
+        :param data: The image to explore, anything Vm.load accepts
+        :param int processes: The size of the process pool, the CPU count when None
+        :param int max_depth: The longest command sequence to try
+        :param int max_states: Stop once this many distinct states have been seen
+        :param tuple verbs: The verbs to try on items besides walking through exits
+        :param bool fuse: Have the VMs fuse instruction sequences into superinstructions, see Vm.decode_fused
+        """
+        self.data = data
+        self.processes = processes
+        self.max_depth = max_depth
+        self.max_states = max_states
+        self.verbs = verbs
+        self.fuse = fuse
+
+        self.seen = set()
+        self.rooms = {}
+        self.room_names = {}
+        self.codes = {}
+
+    def explore(self):
+        """ Run the search
+        :returns dict rooms, keyed by name, each with its 'exits' (exit -> room) and 'items'
+        """
+        vm = Vm(compact=True, fuse=self.fuse)
+        vm.input_provider = None
+        vm.load(self.data)
+        output = run_to_prompt(vm)
+
+        self.seen.add(vm.state_digest())
+        start = State(Snapshot.dumps(vm), [], self.record_room(None, None, output), output, frozenset())
+        self.record_codes(output, [])
+
+        pool = Pool(self.processes)
+        try:
+            frontier = [start]
+            for depth in range(self.max_depth):
+                if len(frontier) == 0 or len(self.seen) >= self.max_states:
+                    break
+                frontier = self.expand_level(pool, frontier)
+        finally:
+            pool.close()
+            pool.join()
+
+        return self.rooms
+
+    def expand_level(self, pool, frontier):
+        """ Expand every state of one level, returning the new states found
+        """
+        tasks = []
+        origins = []
+        for state in frontier:
+            for command in state.commands(self.verbs):
+                tasks.append((state.snapshot, command, self.fuse))
+                origins.append((state, command))
+
+        next_frontier = []
+        results = pool.imap(expand, tasks, chunksize=max(1, len(tasks) // (4 * (self.processes or 4))))
+
+        for (state, command), (snapshot, digest, output, halted) in zip(origins, results):
+            path = state.path + [command]
+            self.record_codes(output, path)
+
+            if halted:
+                continue
+
+            # link the exit even when it leads back to a state that was already seen, that only stops it being expanded
+            room = self.record_room(state.room, command, output)
+
+            if digest in self.seen or len(self.seen) >= self.max_states:
+                continue
+            self.seen.add(digest)
+
+            inventory = state.inventory
+            if command.startswith('take ') and 'Taken.' in output:
+                inventory = inventory | frozenset([command[5:]])
+
+            if room is None:
+                next_frontier.append(State(snapshot, path, state.room, state.description, inventory))
+            else:
+                next_frontier.append(State(snapshot, path, room, output, inventory))
+
+        return next_frontier
+
+    def record_room(self, origin, command, output):
+        """ Add the room described in output to the graph, linking it to the room it was reached from. Rooms sharing a
+        name but not a description are told apart by a number after the name.
+        :returns str the room name or None when output doesn't describe one
+        """
+        rooms = ROOM_PATTERN.findall(output)
+        if len(rooms) == 0:
+            return None
+
+        title, description = rooms[-1]
+        if (title, description) not in self.room_names:
+            count = len([key for key in self.room_names if key[0] == title])
+            self.room_names[(title, description)] = title if count == 0 else "%s #%s" % (title, count + 1)
+
+        name = self.room_names[(title, description)]
+        things, exits = Explorer.parse_lists(output)
+
+        room = self.rooms.setdefault(name, {'exits': {}, 'items': set()})
+        room['items'].update(things)
+        for exit in exits:
+            room['exits'].setdefault(exit, None)
+
+        if origin is not None and command in self.rooms[origin]['exits']:
+            self.rooms[origin]['exits'][command] = name
+
+        return name
+
+    def record_codes(self, output, path):
+        for code in CODE_PATTERN.findall(output):
+            if code not in self.codes or len(path) < len(self.codes[code]):
+                self.codes[code] = path
+
+    def report(self):
+        """ A text report of the rooms found and the commands reaching each code
+        :returns str
+        """
+        lines = []
+        for name in sorted(self.rooms):
+            room = self.rooms[name]
+            lines.append("== %s ==" % name)
+            for item in sorted(room['items']):
+                lines.append("  item: %s" % item)
+            for exit in sorted(room['exits']):
+                lines.append("  %s -> %s" % (exit, room['exits'][exit]))
+
+        lines.append("")
+        for code, path in sorted(self.codes.items(), key=lambda item: len(item[1])):
+            lines.append("%s: %s" % (code, ", ".join(path)))
+
+        return "\n".join(lines)
+
+    @staticmethod
+    def parse_lists(output):
+        """ Pull the items and exits out of the last room description in output
+        :returns tuple (items, exits)
+        """
+        things = []
+        exits = []
+
+        description = output[output.rfind('== '):] if '== ' in output else output
+        for heading, entries in LIST_PATTERN.findall(description):
+            values = [entry[2:] for entry in entries.strip('\n').split('\n')]
+            if heading.startswith('Things'):
+                things = values
+            else:
+                exits = values
+
+        return things, exits
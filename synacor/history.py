@@ -0,0 +1,212 @@
+"""
+    Bounded execution trace with periodic snapshots, enough to step a VM back to any point in its window.
+"""
+
+from array import array
+from collections import deque
+
+from vm import Snapshot, REGISTER_WRITERS, REGISTER_0, REGISTER_7, MAX_MEMORY_ADDRESS
+from pubsub import Publisher
+from terminal import OutputBuffer, CaptureSink
+
+DEFAULT_SIZE = 100000
+DEFAULT_SNAPSHOT_INTERVAL = 10000
+
+# words per entry: exec_ptr, opcode, register written, its value before the instruction
+ENTRY_WORDS = 4
+NO_REGISTER = 8
+
+
+class RecordingInput(object):
+    """ Input provider wrapped around another one that remembers which step read every line, so a rewound VM reads the
+    same lines again on its way forward
+    """
+
+    def __init__(self, provider, trace):
+        """
+        :param provider: The provider to read new lines from, None when input is only fed
+        :param TraceBuffer trace: The trace whose step count lines are stamped with
+        """
+        self.provider = provider
+        self.trace = trace
+        self.log = deque()
+        self.pending = deque()
+
+    def read_line(self):
+        if len(self.pending) > 0:
+            entry = self.pending.popleft()
+        else:
+            line = self.provider.read_line() if self.provider is not None else None
+            if line is None:
+                return None
+            entry = (self.trace.steps, line)
+
+        self.log.append(entry)
+        return entry[1]
+
+    def rewind(self, step):
+        """ Give back every line read from step on, they are read again before anything new
+        """
+        lines = deque()
+        while len(self.log) > 0 and self.log[-1][0] >= step:
+            lines.appendleft(self.log.pop())
+
+        lines.extend(self.pending)
+        self.pending = lines
+
+    def forget(self, step):
+        """ Drop the lines read before step, nothing can rewind that far anymore
+        """
+        while len(self.log) > 0 and self.log[0][0] < step:
+            self.log.popleft()
+
+
+class TraceBuffer(object):
+    """ Records the last size instructions a VM ran in a preallocated array('H') ring, each entry the execution pointer,
+    the opcode and the register the instruction writes along with the value it had before. A snapshot is taken every
+    snapshot_interval instructions and only as many are kept as the ring covers, so memory stays the same however long
+    the VM runs.
+
+    Stepping back restores the last snapshot at or before the target and runs forward to it with nothing listening,
+    the lines read from the input provider in between are replayed through RecordingInput.
+
+    Instructions the VM runs without being traced, in slices while the debugger is resumed, are accounted for with
+    advance. Only snapshots are taken for those, so they can be stepped back into but have no entries.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        """
+        :param int size: The number of instructions to keep
+        :param int snapshot_interval: Instructions between snapshots
+        """
+        self.size = size
+        self.snapshot_interval = snapshot_interval
+        self.entries = array('H', [0]) * (size * ENTRY_WORDS)
+        self.snapshots = deque(maxlen=size // snapshot_interval + 1)
+        self.steps = 0
+        # the first step with an entry, the ones before it ran untraced
+        self.first_entry = 0
+        self.input = None
+
+    def attach(self, vm):
+        """ Record the lines vm reads so they can be replayed, call before tracing it
+        :param Vm vm: The VM that will be traced
+        """
+        self.input = RecordingInput(vm.input_provider, self)
+        vm.input_provider = self.input
+
+    def restart(self):
+        """ Empty the window, for when the VM ran on without being traced
+        """
+        self.steps = 0
+        self.first_entry = 0
+        self.snapshots.clear()
+        if self.input is not None:
+            self.input.log.clear()
+
+    @property
+    def oldest(self):
+        """ The earliest step that can be rewound to
+        """
+        return self.snapshots[0][0] if len(self.snapshots) > 0 else self.steps
+
+    def record(self, vm):
+        """ Record the instruction vm is about to execute
+        :param Vm vm: The traced VM
+        """
+        steps = self.steps
+        self.take_snapshot(vm)
+
+        memory = vm.memory
+        exec_ptr = vm.exec_ptr
+        opcode = memory[exec_ptr]
+
+        entries = self.entries
+        index = (steps % self.size) * ENTRY_WORDS
+        entries[index] = exec_ptr
+        entries[index + 1] = opcode
+
+        if opcode in REGISTER_WRITERS and exec_ptr < MAX_MEMORY_ADDRESS and \
+                REGISTER_0 <= memory[exec_ptr + 1] <= REGISTER_7:
+            register = memory[exec_ptr + 1] - REGISTER_0
+            entries[index + 2] = register
+            entries[index + 3] = vm.registers[register]
+        else:
+            entries[index + 2] = NO_REGISTER
+
+        self.steps = steps + 1
+
+    def advance(self, vm, executed):
+        """ Account for instructions vm ran without being traced, snapshotting it once snapshot_interval instructions
+        have gone by since the last snapshot
+        :param Vm vm: The traced VM, as it is after them
+        :param int executed: How many it ran
+        """
+        self.steps += executed
+        self.first_entry = self.steps
+        self.take_snapshot(vm)
+
+    def take_snapshot(self, vm):
+        """ Snapshot vm as it is at the current step if the last snapshot is snapshot_interval steps back
+        """
+        if len(self.snapshots) > 0 and self.steps - self.snapshots[-1][0] < self.snapshot_interval:
+            return
+
+        self.snapshots.append((self.steps, Snapshot.dumps(vm)))
+        if self.input is not None:
+            self.input.forget(self.snapshots[0][0])
+
+    def entry(self, step):
+        """ The entry of an instruction still in the window
+        :param int step: The number of instructions traced before it
+        :returns tuple (exec_ptr, opcode, register, value before), register is None when it didn't write one
+        """
+        if step < max(self.steps - self.size, self.first_entry, 0) or step >= self.steps:
+            raise IndexError("Step %s is outside of the trace" % step)
+
+        index = (step % self.size) * ENTRY_WORDS
+        exec_ptr, opcode, register, value = self.entries[index:index + ENTRY_WORDS]
+
+        return exec_ptr, opcode, register if register != NO_REGISTER else None, value
+
+    def tail(self, count):
+        """ The entries of the last count instructions
+        :returns list of (step, exec_ptr, opcode, register, value before)
+        """
+        first = max(self.steps - count, self.steps - self.size, self.first_entry, 0)
+        return [(step,) + self.entry(step) for step in range(first, self.steps)]
+
+    def rewind(self, vm, target):
+        """ Put vm back to how it was before instruction target ran
+        :param Vm vm: The traced VM
+        :param int target: The number of instructions traced before the point to go back to
+        :raises ValueError when target is outside of the window
+        """
+        if target < self.oldest or target > self.steps:
+            raise ValueError("Can only go back to steps %s...%s" % (self.oldest, self.steps))
+
+        while self.snapshots[-1][0] > target:
+            self.snapshots.pop()
+
+        step, data = self.snapshots[-1]
+        Snapshot.loads(data, vm)
+
+        if self.input is not None:
+            self.input.rewind(step)
+
+        # run forward to target without the debugger, breakpoints or the terminal seeing it again
+        publisher = vm.publisher
+        output = vm.output
+        vm.publisher = Publisher()
+        vm.output = OutputBuffer(CaptureSink())
+        self.steps = step
+
+        try:
+            vm.run_for(target - step)
+        finally:
+            vm.publisher = publisher
+            vm.output = output
+            vm.halt = False
+
+        self.steps = target
+        self.first_entry = min(self.first_entry, target)
@@ -0,0 +1,320 @@
+"""
+    Basic block compiler that turns straight-line runs of VM code into Python functions.
+"""
+
+from vm import Vm, AddressCache, INSTRUCTIONS, HALT, SET, PUSH, POP, EQ, GT, JMP, JT, JF, ADD, MULT, MOD, AND, OR, \
+    NOT, RMEM, WMEM, CALL, RET, OUT, IN, MAX_INT
+
+# instructions that end a block, only the jumps are compiled, the rest are handed back to the interpreter
+BLOCK_TERMINATORS = [JMP, JT, JF, CALL, RET, OUT, IN, HALT]
+
+# the vm attributes a compiled instruction needs in locals
+BLOCK_ATTRIBUTES = {
+    PUSH: ['stack'],
+    POP: ['stack'],
+    RMEM: ['memory'],
+    WMEM: ['memory', 'invalidate'],
+}
+
+MAX_BLOCK_INSTRUCTIONS = 256
+
+
+class BlockCompiler(object):
+    """ Compiles the basic block starting at an address into a function(vm, registers) that runs it and returns the
+    address to continue at. A negative return value (~address) asks the caller to run the instruction at address through
+    the interpreter, which is how terminators other than the jumps, faults and undecodable code are handled.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+
+    def compile(self, start):
+        """ Compile the block that starts at start
+        :param int start: The memory address the block starts at
+        :returns tuple (function, end) where end is the address just past the last word the block was compiled from
+        """
+        source, end = self.generate(start)
+
+        namespace = {}
+        exec compile(source, '<block %s>' % str(start).zfill(5), 'exec') in namespace
+
+        return namespace['block'], end
+
+    def generate(self, start):
+        """ Generate the source of the block that starts at start
+        :param int start: The memory address the block starts at
+        :returns tuple (source, end)
+        """
+        lines = []
+        used = set()
+        dirty = set()
+        attributes = set()
+        address = start
+        loops = False
+
+        for _ in range(MAX_BLOCK_INSTRUCTIONS):
+            if address in self.vm.native_routines or address in self.vm.breakpoints:
+                lines.append(Exit(address, interpret=True))
+                break
+
+            if self.vm.loop_detector is not None and address in self.vm.loop_detector.headers:
+                # the loop detector is told about every arrival at a loop header through the interpreter
+                lines.append(Exit(address, interpret=True))
+                break
+
+            try:
+                _, next_ptr, a, b, c = self.vm.decode(address)
+            except (ValueError, OverflowError, IndexError):
+                # let the interpreter raise for it if execution ever really gets here
+                lines.append(Exit(address, interpret=True))
+                break
+
+            instruction = self.vm.memory[address]
+
+            if instruction in (JMP, JT, JF) and self.vm.loop_detector is not None and \
+                    (a if instruction == JMP else b) <= address:
+                # backward jumps sample the loop detector through the interpreter
+                lines.append(Exit(address, interpret=True))
+                break
+
+            if instruction in (RMEM, WMEM) and self.vm.watch_flags is not None:
+                # watched memory accesses go through the interpreter's watched handlers
+                lines.append(Exit(address, interpret=True))
+                break
+
+            used.update(self.read_registers(a, b, c))
+
+            if instruction in (JT, JF):
+                test = '>' if instruction == JT else '=='
+                lines.append('if %s %s 0:' % (self.value(a), test))
+                if b == start:
+                    loops = True
+                    lines.append([BackEdge()])
+                else:
+                    lines.append([Exit(b)])
+                lines.append(Exit(next_ptr))
+                address = next_ptr
+                break
+            elif instruction == JMP:
+                lines.append(BackEdge() if a == start else Exit(a))
+                if a == start:
+                    loops = True
+                address = next_ptr
+                break
+            elif instruction in BLOCK_TERMINATORS:
+                lines.append(Exit(address, interpret=True))
+                address = next_ptr
+                break
+
+            if instruction in (SET, POP, EQ, GT, ADD, MULT, MOD, AND, OR, NOT, RMEM):
+                used.add(a)
+                dirty.add(a)
+
+            attributes.update(BLOCK_ATTRIBUTES.get(instruction, []))
+
+            lines.extend(self.generate_instruction(instruction, address, a, b, c))
+            address = next_ptr
+        else:
+            lines.append(Exit(address))
+
+        end = address
+        body = self.render(lines, start, end, dirty)
+
+        source = ['def block(vm, registers):']
+        source += ['    r%s = registers[%s]' % (register, register) for register in sorted(used)]
+        source += ['    %s = vm.%s' % (name, name) for name in sorted(attributes)]
+
+        if loops:
+            source.append('    while True:')
+            source += ['        ' + line for line in body]
+        else:
+            source += ['    ' + line for line in body]
+
+        return '\n'.join(source) + '\n', end
+
+    def generate_instruction(self, instruction, address, a, b, c):
+        """ Generate the lines for one straight-line instruction, the operands are as decoded by Vm.decode
+        """
+        name = INSTRUCTIONS[instruction]
+        lines = ['# %s: %s' % (str(address).zfill(5), name)]
+
+        if instruction == SET:
+            lines.append('r%s = %s' % (a, self.value(b)))
+        elif instruction == PUSH:
+            lines.append('stack.append(%s)' % self.value(a))
+        elif instruction == POP:
+            lines += ['if len(stack) == 0:', [Exit(address, interpret=True)]]
+            lines.append('r%s = stack.pop()' % a)
+        elif instruction == EQ:
+            lines.append('r%s = 1 if %s == %s else 0' % (a, self.value(b), self.value(c)))
+        elif instruction == GT:
+            lines.append('r%s = 1 if %s > %s else 0' % (a, self.value(b), self.value(c)))
+        elif instruction in (ADD, MULT, MOD, AND, OR):
+            operator = {ADD: '+', MULT: '*', MOD: '%', AND: '&', OR: '|'}[instruction]
+            if instruction == MOD:
+                lines += ['if %s == 0:' % self.value(c), [Exit(address, interpret=True)]]
+            lines.append('r%s = (%s %s %s) %% %s' % (a, self.value(b), operator, self.value(c), MAX_INT))
+        elif instruction == NOT:
+            lines.append('r%s = ~%s %% %s' % (a, self.value(b), MAX_INT))
+        elif instruction == RMEM:
+            lines.append('r%s = memory[%s %% %s]' % (a, self.value(b), MAX_INT))
+        elif instruction == WMEM:
+            lines.append('address = %s %% %s' % (self.value(a), MAX_INT))
+            lines.append('memory[address] = %s' % self.value(b))
+            lines.append('invalidate(address)')
+            # the block may have just rewritten itself, leave it before running anything stale
+            lines += [SelfModificationGuard(address + 3)]
+
+        return lines
+
+    def render(self, lines, start, end, dirty, depth=0):
+        """ Turn the nested line list into indented source, expanding exits into register write backs
+        """
+        rendered = []
+        indent = '    ' * depth
+
+        for line in lines:
+            if isinstance(line, list):
+                rendered += self.render(line, start, end, dirty, depth + 1)
+            elif isinstance(line, SelfModificationGuard):
+                rendered.append(indent + 'if %s <= address < %s:' % (start, end))
+                rendered += self.render([Exit(line.next_ptr)], start, end, dirty, depth + 1)
+            elif isinstance(line, BackEdge):
+                # a block that loops on itself never returns to run_fast, so it checks for an interrupt each time round
+                rendered.append(indent + 'if vm._interrupted or vm.halt:')
+                rendered += self.render([Exit(start)], start, end, dirty, depth + 1)
+                rendered.append(indent + 'continue')
+            elif isinstance(line, Exit):
+                rendered += [indent + 'registers[%s] = r%s' % (register, register) for register in sorted(dirty)]
+                rendered.append(indent + 'return %s' % (~line.address if line.interpret else line.address))
+            else:
+                rendered.append(indent + line)
+
+        return rendered
+
+    def read_registers(self, a, b, c):
+        """ Returns the registers read by a decoded instruction, only value operands are ever negative
+        """
+        return [~operand for operand in (a, b, c) if operand is not None and operand < 0]
+
+    def value(self, operand):
+        """ The expression for a decoded value operand
+        """
+        if operand < 0:
+            return 'r%s' % ~operand
+        return str(operand)
+
+
+class Exit(object):
+    def __init__(self, address, interpret=False):
+        self.address = address
+        self.interpret = interpret
+
+
+class SelfModificationGuard(object):
+    def __init__(self, next_ptr):
+        self.next_ptr = next_ptr
+
+
+class BackEdge(object):
+    pass
+
+
+class JitVm(Vm):
+    """ A VM that compiles basic blocks into Python functions and runs those whenever nothing is subscribed to the step
+    event. Blocks are cached per start address and chained through that cache, a write into a block drops it.
+    """
+
+    @Vm.memory.setter
+    def memory(self, data):
+        Vm.memory.fset(self, data)
+        self._blocks = self.new_address_cache(len(data) + 1)
+        self._block_owners = AddressCache(default=frozenset())
+
+    def __init__(self, compact=False, fuse=False):
+        self._blocks = []
+        self._block_owners = AddressCache(default=frozenset())
+
+        super(JitVm, self).__init__(compact=compact, fuse=fuse)
+
+        self._blocks = self.new_address_cache(len(self.memory) + 1)
+        self.compiler = BlockCompiler(self)
+
+    def run_fast(self):
+        """ Executes compiled blocks until halted or interrupted, dropping back to the interpreter for one instruction
+        whenever a block asks for it. With fuse set that instruction is decoded as a superinstruction, which is how runs
+        of out leave a block.
+        """
+        registers = self._registers
+        blocks = self._blocks
+        decoded = self._fused if self.fuse else self._decoded
+        decode = self.decode_fused if self.fuse else self.decode
+        exec_ptr = self._exec_ptr
+
+        try:
+            while not self.halt and not self._interrupted:
+                block = blocks[exec_ptr]
+                if block is None:
+                    block = self.compile_block(exec_ptr)
+
+                exec_ptr = block(self, registers)
+
+                if exec_ptr < 0:
+                    exec_ptr = ~exec_ptr
+
+                    record = decoded[exec_ptr]
+                    if record is None:
+                        record = decode(exec_ptr)
+
+                    exec_ptr = record[0](self, registers, record)
+        finally:
+            self._exec_ptr = exec_ptr
+
+    def compile_block(self, start):
+        """ Compiles and caches the block at start
+        :param int start: The memory address the block starts at
+        :returns the compiled block
+        """
+        if start > (len(self.memory) - 1):
+            raise OverflowError("Execution pointer has overran memory: " + str(start))
+
+        block, end = self.compiler.compile(start)
+
+        self._blocks[start] = block
+
+        # frozensets so forks can share the owners without copying them
+        owners = self._block_owners
+        for address in range(start, end):
+            owners[address] = owners[address] | frozenset([start])
+
+        return block
+
+    def fork(self):
+        """ Returns a copy of this VM as Vm.fork does, the child starts out with the compiled blocks of this one
+        :returns JitVm
+        """
+        child = super(JitVm, self).fork()
+        child._blocks, self._blocks = Vm.fork_cache(self._blocks)
+        child._block_owners, self._block_owners = Vm.fork_cache(self._block_owners)
+        child.compiler = BlockCompiler(child)
+
+        return child
+
+    def drop_decoded(self):
+        """ Forget every decoded instruction and compiled block
+        """
+        super(JitVm, self).drop_decoded()
+        self._blocks = self.new_address_cache(len(self.memory) + 1)
+        self._block_owners = AddressCache(default=frozenset())
+
+    def invalidate(self, address):
+        """ Drops decoded instructions and compiled blocks that were built from the word at address.
+        :param int address: The memory address that was written to
+        """
+        super(JitVm, self).invalidate(address)
+
+        starts = self._block_owners[address]
+        if starts:
+            self._block_owners[address] = frozenset()
+            for start in starts:
+                self._blocks[start] = None
@@ -0,0 +1,178 @@
+"""
+    Loop detector that notices execution cycling through the same code, sampling only when a backward jump is taken.
+"""
+
+from collections import deque
+
+from vm import Vm, Snapshot, STOP_BREAKPOINT
+from terminal import OutputBuffer, CaptureSink
+
+DEFAULT_HISTORY = 256
+DEFAULT_THRESHOLD = 1000
+
+# the most instructions one iteration is measured for
+MEASURE_LIMIT = 1000000
+
+
+class LoopReport(object):
+    """ What is known about a loop that ran past the threshold
+    """
+
+    def __init__(self, header, back_edge):
+        """
+        :param int header: The address the loop jumps back to
+        :param int back_edge: The address of the jump back
+        """
+        self.header = header
+        self.back_edge = back_edge
+        self.iterations = 0
+        self.instructions = None
+        self.registers = {}
+
+    def __str__(self):
+        if self.instructions is None:
+            body = 'iterations of unknown length'
+        else:
+            body = 'iterations of %s instructions' % self.instructions
+
+        changes = ', '.join('@%s %s -> %s' % (register, before, after)
+                            for register, (before, after) in sorted(self.registers.items()))
+
+        return 'loop at %s (back from %s): %s %s, changing %s' % (str(self.header).zfill(5),
+                                                                  str(self.back_edge).zfill(5), self.iterations, body,
+                                                                  changes if changes else 'no registers')
+
+
+class LoopDetector(object):
+    """ Keeps the headers of the last history backward jumps taken and how often each was jumped back to in its current
+    activation. A header reached any other way than by its own back edge starts a new activation, so a loop entered
+    over and over counts the iterations of each entry rather than all of them together. A header that drops out of the
+    window has finished looping and is forgotten, so memory stays bounded by history and the number of loop headers.
+    Once an activation jumps back to its header threshold times, and again every time that count grows tenfold, the loop
+    is reported through the VM's loop event.
+
+    Instructions per iteration and the registers an iteration changes are measured when an activation is first
+    reported, by running one iteration on a copy of the VM.
+
+    Attaching makes backward jumps decode to handlers that call back_edge and the headers they jump to to a wrapper that
+    calls entered, nothing else pays for the detector.
+    """
+
+    def __init__(self, history=DEFAULT_HISTORY, threshold=DEFAULT_THRESHOLD):
+        """
+        :param int history: How many backward jumps to remember
+        :param int threshold: Iterations before a loop is reported
+        """
+        self.history = history
+        self.threshold = threshold
+        self.recent = deque()
+        self.occurrences = {}
+        self.iterations = {}
+        self.loops = {}
+        # every address a backward jump went to, they decode to a wrapper that calls entered
+        self.headers = set()
+        # the header the last back edge jumped to, so entered can tell an iteration from a new activation
+        self.arrived = None
+
+    def attach(self, vm):
+        vm.loop_detector = self
+        vm.drop_decoded()
+
+    def detach(self, vm):
+        if vm.loop_detector is self:
+            vm.loop_detector = None
+            vm.drop_decoded()
+
+    def back_edge(self, vm, source, header):
+        """ Called by every backward jump taken
+        :param Vm vm: The VM that jumped
+        :param int source: The address of the jump
+        :param int header: The address jumped to
+        """
+        recent = self.recent
+        occurrences = self.occurrences
+
+        self.arrived = header
+        if header not in self.headers:
+            self.headers.add(header)
+            # decode it again as a header, this back edge is the first arrival entered sees
+            vm.invalidate(header)
+
+        recent.append(header)
+        occurrences[header] = occurrences.get(header, 0) + 1
+
+        if len(recent) > self.history:
+            oldest = recent.popleft()
+            occurrences[oldest] -= 1
+            if occurrences[oldest] == 0:
+                del occurrences[oldest]
+                del self.iterations[oldest]
+
+        iterations = self.iterations.get(header, 0) + 1
+        self.iterations[header] = iterations
+
+        if header in self.loops:
+            report = self.loops[header]
+            report.iterations = max(report.iterations, iterations)
+
+        if iterations % self.threshold == 0 and LoopDetector.is_milestone(iterations // self.threshold):
+            self.report(vm, source, header, iterations)
+
+    def entered(self, header):
+        """ Called every time execution reaches a known loop header
+        :param int header: The address of the header
+        """
+        if self.arrived == header:
+            self.arrived = None
+            return
+
+        # fell or jumped in from outside of the loop, the iterations of the last activation don't carry over
+        if header in self.iterations:
+            self.iterations[header] = 0
+
+    def report(self, vm, source, header, iterations):
+        report = self.loops.get(header)
+        if report is None or iterations == self.threshold:
+            report = LoopReport(header, source)
+            report.instructions, report.registers = LoopDetector.measure(vm, header)
+            self.loops[header] = report
+
+        report.iterations = iterations
+        vm.publisher.publish('loop', vm=vm, report=report)
+
+    @staticmethod
+    def is_milestone(multiple):
+        """ Whether multiple is 1, 10, 100...
+        """
+        while multiple % 10 == 0:
+            multiple //= 10
+        return multiple == 1
+
+    @staticmethod
+    def measure(vm, header):
+        """ Run one iteration of the loop at header on a copy of vm, which is about to start one
+        :returns tuple (instructions, registers) with registers index -> (before, after) for those that changed,
+            (None, {}) when the iteration didn't come back to header
+        """
+        copy = Vm()
+        copy.input_provider = None
+        copy.output = OutputBuffer(CaptureSink())
+        Snapshot.loads(Snapshot.dumps(vm), copy)
+        # a running VM only writes its execution pointer back when it stops
+        copy.exec_ptr = header
+
+        before = list(copy.registers)
+        if copy.run_until([header], MEASURE_LIMIT) != STOP_BREAKPOINT:
+            return None, {}
+
+        changed = dict((register, (old, new)) for register, (old, new) in enumerate(zip(before, copy.registers))
+                       if old != new)
+
+        return copy.last_executed, changed
+
+    def summary(self):
+        """ Every loop reported so far, the one that ran longest first
+        :returns str
+        """
+        reports = sorted(self.loops.values(), key=lambda report: report.iterations, reverse=True)
+        return '\n'.join(str(report) for report in reports)
@@ -0,0 +1,488 @@
+"""
+    Native Python replacements for VM routines that are too slow to interpret.
+"""
+
+import hashlib
+
+import numpy
+
+from multiprocessing import Pool
+
+from vm import Vm, Snapshot, MAX_INT, STOP_BREAKPOINT
+from terminal import OutputBuffer, CaptureSink
+
+TELEPORTER_CONFIRMATION = 6027
+
+TELEPORTER_ARGUMENTS = (4, 1)
+TELEPORTER_EXPECTED = 6
+
+# the library routines of challenge.bin, see extracted-functions.src
+MEM_MAP = 1458
+PRINT_STRING = 1518
+PRINT_CHAR = 1528
+PRINT_TOGGLED_CHAR = 1531
+TOGGLE_BIT = 2125
+
+# the code each one runs, (start, end) with end exclusive, and the sha1 of its words
+MEM_MAP_CODE = ([(1458, 1518)], 'f35076a8e036b5a55c9912e09dc8fec1f88c072c')
+PRINT_STRING_CODE = ([(1518, 1528), (1458, 1518), (1528, 1531)], 'f4b904d0091738bbe3845d9a50c9a5fd7a886dcb')
+PRINT_CHAR_CODE = ([(1528, 1531)], 'df773b034a68861f8eea111026f70214ac9788a6')
+PRINT_TOGGLED_CHAR_CODE = ([(1531, 1543), (2125, 2149)], 'e57317af2f79591c72f2518a3ee8822089b6b3e5')
+
+# the most instructions the interpreted code is run for when verifying a native routine
+VERIFY_LIMIT = 10000000
+
+
+class TeleporterConfirmation(object):
+    """ The teleporter's energy level confirmation at 6027, an Ackermann like recursion on @0 and @1 using @7:
+
+        f(0, b) = b + 1
+        f(a, 0) = f(a - 1, @7)
+        f(a, b) = f(a - 1, f(a, b - 1))
+
+    all modulo 32768. The routine returns f in @0 and, since the last instruction it runs is always the `add @0, @1, 1`
+    of the first case, f - 1 in @1. Nothing else is touched and the stack is balanced.
+
+    Rather than recursing every row of f is built iteratively, row a from row a - 1, and kept for the last @7 seen.
+    """
+
+    def __init__(self):
+        self.energy_level = None
+        self.rows = []
+
+    def __call__(self, vm, registers, address):
+        a, b, energy_level = registers[0], registers[1], registers[7]
+
+        # only defined for the values the arithmetic keeps things within, anything else gets interpreted
+        if a >= MAX_INT or b >= MAX_INT or energy_level >= MAX_INT:
+            return None
+
+        result = self.confirm(a, b, energy_level)
+
+        registers[0] = result
+        registers[1] = (result + MAX_INT - 1) % MAX_INT
+
+        return vm.native_return(address)
+
+    def confirm(self, a, b, energy_level):
+        """ Evaluate f(a, b) for the passed in value of @7
+        :param int a: @0
+        :param int b: @1
+        :param int energy_level: @7
+        :returns int
+        """
+        if a == 0:
+            return (b + 1) % MAX_INT
+
+        if energy_level != self.energy_level:
+            self.energy_level = energy_level
+            self.rows = [range(1, MAX_INT) + [0]]
+
+        while len(self.rows) < a:
+            self.rows.append(self.build_row(self.rows[-1], energy_level, MAX_INT - 1))
+
+        return self.build_row(self.rows[a - 1], energy_level, b)[b]
+
+    @staticmethod
+    def build_row(previous, energy_level, b):
+        """ Build f(a, 0) ... f(a, b) from the row of a - 1
+        :param list previous: f(a - 1, 0) ... f(a - 1, 32767)
+        :param int energy_level: @7
+        :param int b: The last entry to build
+        :returns list
+        """
+        value = previous[energy_level]
+        row = [value]
+        append = row.append
+
+        for _ in xrange(b):
+            value = previous[value]
+            append(value)
+
+        return row
+
+
+class EnergyLevelSolver(object):
+    """ Evaluates the teleporter confirmation for every candidate value of @7 at once. Rows 0 through 2 of f are affine
+    in b for a fixed @7:
+
+        f(0, b) = b + 1
+        f(1, b) = b + @7 + 1
+        f(2, b) = (@7 + 1) * b + 2 * @7 + 1
+
+    and every row is the one below it applied b + 1 times to @7, f(a, b) = f(a - 1, .)^(b + 1)(@7). Row 3 iterates an
+    affine map so it is found by repeated squaring of that map, row 4 by applying row 3 as often as b asks. Everything
+    is computed across a vector of candidates with modulo 32768 arithmetic.
+    """
+
+    ROWS = 5
+
+    def __init__(self, candidates=None):
+        """
+        :param candidates: The values of @7 to evaluate, every 15-bit value when None
+        """
+        if candidates is None:
+            candidates = numpy.arange(MAX_INT, dtype=numpy.int64)
+        self.candidates = numpy.asarray(candidates, dtype=numpy.int64) % MAX_INT
+
+        # f(a, b) = multipliers[a] * b + offsets[a] for the affine rows
+        self.multipliers = numpy.ones((3, len(self.candidates)), dtype=numpy.int64)
+        self.offsets = numpy.ones((3, len(self.candidates)), dtype=numpy.int64)
+        self.offsets[1] = (self.candidates + 1) % MAX_INT
+        self.multipliers[2] = (self.candidates + 1) % MAX_INT
+        self.offsets[2] = (2 * self.candidates + 1) % MAX_INT
+
+        # f(a, 0) for every row and candidate
+        self.bases = numpy.zeros((self.ROWS, len(self.candidates)), dtype=numpy.int64)
+        self.bases[0] = 1
+        for a in range(1, self.ROWS):
+            self.bases[a] = self.evaluate(a - 1, self.candidates)
+
+    def evaluate(self, a, b):
+        """ Evaluate f(a, b) for every candidate
+        :param int a: @0, at most 4
+        :param b: @1, an int or an array with one value per candidate
+        :returns numpy.ndarray
+        """
+        if not 0 <= a < self.ROWS:
+            raise ValueError("Only rows 0 through %s can be evaluated: %s" % (self.ROWS - 1, a))
+
+        b = numpy.zeros(len(self.candidates), dtype=numpy.int64) + b
+
+        if a < 3:
+            return (self.multipliers[a] * b + self.offsets[a]) % MAX_INT
+
+        if a == 3:
+            return self.iterate_affine(self.multipliers[2], self.offsets[2], b + 1, self.candidates)
+
+        values = self.bases[a].copy()
+        for step in range(int(b.max())):
+            pending = step < b
+            values[pending] = self.evaluate(a - 1, values)[pending]
+
+        return values
+
+    def solve(self, a=TELEPORTER_ARGUMENTS[0], b=TELEPORTER_ARGUMENTS[1], expected=TELEPORTER_EXPECTED):
+        """ Find every candidate for which f(a, b) comes out as expected
+        :returns list
+        """
+        return [int(candidate) for candidate in self.candidates[self.evaluate(a, b) == expected]]
+
+    @staticmethod
+    def iterate_affine(multiplier, offset, count, value):
+        """ Apply x -> multiplier * x + offset to value count times, each argument holding one entry per candidate
+        :returns numpy.ndarray
+        """
+        result_multiplier = numpy.ones_like(multiplier)
+        result_offset = numpy.zeros_like(offset)
+        count = count.copy()
+
+        while count.any():
+            odd = (count & 1) == 1
+            result_multiplier = numpy.where(odd, result_multiplier * multiplier % MAX_INT, result_multiplier)
+            result_offset = numpy.where(odd, (result_offset * multiplier + offset) % MAX_INT, result_offset)
+
+            offset = (offset * multiplier + offset) % MAX_INT
+            multiplier = multiplier * multiplier % MAX_INT
+            count >>= 1
+
+        return (result_multiplier * value + result_offset) % MAX_INT
+
+
+class RoutineSignature(object):
+    """ Recognises a routine by the sha1 of the words of every span of code it runs, so a routine is only stood in for
+    where the image holds exactly the code the native replacement was written against.
+    """
+
+    def __init__(self, name, address, spans, digest):
+        """
+        :param str name: What the routine is called in the listings
+        :param int address: Where it is called
+        :param list spans: (start, end) of the code it runs, end exclusive, including any routine it calls
+        :param str digest: The sha1 of the words of every span in order, as little endian uint16
+        """
+        self.name = name
+        self.address = address
+        self.spans = spans
+        self.digest = digest
+
+    def words(self, memory):
+        """ The words of every span in memory, None when a span runs past the end of it
+        :returns tuple
+        """
+        if any(end > len(memory) for _, end in self.spans):
+            return None
+
+        return tuple(memory[address] for start, end in self.spans for address in xrange(start, end))
+
+    def matches(self, memory):
+        """ Whether memory holds the routine
+        :returns bool
+        """
+        words = self.words(memory)
+        if words is None:
+            return False
+
+        return hashlib.sha1(numpy.array(words, dtype='<u2').tostring()).hexdigest() == self.digest
+
+
+class LibraryRoutine(object):
+    """ A native routine standing in for code recognised by its signature. The code is interpreted instead whenever it
+    has been rewritten since, a breakpoint is set inside it or memory is being watched, since the native routine would
+    skip past those.
+    """
+
+    def __init__(self, signature):
+        self.signature = signature
+
+    def applies(self, vm, signature=None):
+        """ Whether the native routine can stand in for the code at this call, which is checked on every call since the
+        code can be rewritten at any time. Whether memory holds the code is remembered by the VM until it is written to.
+        :param RoutineSignature signature: The code to check, the routine's own when None
+        :returns bool
+        """
+        signature = signature if signature is not None else self.signature
+
+        if vm.watch_flags is not None:
+            return False
+
+        for start, end in signature.spans:
+            if any(start <= breakpoint < end for breakpoint in vm.breakpoints):
+                return False
+
+        matches = vm.signature_matches.get(signature)
+        if matches is None:
+            matches = signature.matches(vm.memory)
+            vm.remember_signature(signature, signature.spans, matches)
+
+        return matches
+
+    @staticmethod
+    def string(vm, address):
+        """ The characters of the length prefixed string at address, None when it runs past the end of memory
+        :returns list
+        """
+        memory = vm.memory
+        if address >= len(memory):
+            return None
+
+        end = address + 1 + memory[address]
+        if end > len(memory):
+            return None
+
+        return [memory[offset] for offset in xrange(address + 1, end)]
+
+
+class MemMap(LibraryRoutine):
+    """ MEM_MAP at 1458 calls the routine in @1 for every character of the string at @0, passing the character in @0.
+    @0 and @3 through @6 are restored, @1 is left at the number of characters and @2 is whatever the callback left
+    there. Only callbacks with a native kernel are stood in for, a kernel is called with the vm, its registers and the
+    characters and writes what calling the callback on each would, returning False without touching anything when it
+    can't.
+    """
+
+    def __init__(self, signature, callbacks):
+        """
+        :param RoutineSignature signature: MEM_MAP's
+        :param dict callbacks: address -> (RoutineSignature, kernel)
+        """
+        super(MemMap, self).__init__(signature)
+        self.callbacks = callbacks
+
+    def __call__(self, vm, registers, address):
+        if registers[1] not in self.callbacks or not self.applies(vm):
+            return None
+
+        signature, kernel = self.callbacks[registers[1]]
+        if not self.applies(vm, signature):
+            return None
+
+        characters = LibraryRoutine.string(vm, registers[0])
+        # a string of 32767 characters never ends the loop
+        if characters is None or len(characters) >= MAX_INT - 1 or not kernel(vm, registers, characters):
+            return None
+
+        registers[1] = len(characters)
+
+        return vm.native_return(address)
+
+
+class PrintString(LibraryRoutine):
+    """ PRINT_STRING at 1518 writes the string at @0 out through MEM_MAP and PRINT_CHAR, leaving every register as it
+    was.
+    """
+
+    def __call__(self, vm, registers, address):
+        if not self.applies(vm):
+            return None
+
+        characters = LibraryRoutine.string(vm, registers[0])
+        if characters is None or len(characters) >= MAX_INT - 1 or not print_characters(vm, registers, characters):
+            return None
+
+        return vm.native_return(address)
+
+
+def print_characters(vm, registers, characters):
+    """ PRINT_CHAR at 1528, `out @0`
+    """
+    if any(character > 255 for character in characters):
+        return False
+
+    vm.output.write_string(str(bytearray(characters)))
+    return True
+
+
+def print_toggled_characters(vm, registers, characters):
+    """ PRINT_TOGGLED_CHAR at 1531, writes TOGGLE_BIT(@0, @2) which for 15-bit values is @0 xor @2. @0 is clobbered but
+    MEM_MAP restores it, so only the output is left to reproduce and the whole string is decoded at once.
+    """
+    decoded = numpy.array(characters, dtype=numpy.uint16) ^ registers[2]
+    if len(decoded) > 0 and decoded.max() > 255:
+        return False
+
+    vm.output.write_string(decoded.astype(numpy.uint8).tostring())
+    return True
+
+
+class VerifiedRoutine(object):
+    """ Runs a native routine and then the code it stands in for on a copy of the VM without any native routines,
+    raising when the two leave a different execution pointer, registers, stack, memory or output behind.
+    """
+
+    def __init__(self, name, routine):
+        """
+        :param str name: What to call the routine when they disagree
+        :param routine: The native routine
+        """
+        self.name = name
+        self.routine = routine
+        self.verified = 0
+
+    def __call__(self, vm, registers, address):
+        # copied before the native routine changes anything
+        copy = Vm()
+        copy.input_provider = None
+        copy.output = OutputBuffer(CaptureSink())
+        Snapshot.loads(Snapshot.dumps(vm), copy)
+        # a running VM only writes its execution pointer back when it stops
+        copy.exec_ptr = address
+
+        output = vm.output
+        vm.output = OutputBuffer(CaptureSink())
+        try:
+            next_ptr = self.routine(vm, registers, address)
+        finally:
+            vm.output.flush()
+            written = vm.output.sink.getvalue()
+            vm.output = output
+
+        if next_ptr is None:
+            return None
+
+        output.write_string(written)
+
+        depth = len(copy.stack)
+        if copy.run_until(lambda copy: len(copy.stack) < depth, VERIFY_LIMIT) != STOP_BREAKPOINT:
+            raise RuntimeError("%s at %s never returned when interpreted" % (self.name, address))
+
+        copy.output.flush()
+        native = vm.pack_state()[:3] + (next_ptr, written)
+        interpreted = copy.pack_state()[:3] + (copy.exec_ptr, copy.output.sink.getvalue())
+
+        differences = [part for part, ours, theirs in zip(('memory', 'registers', 'stack', 'exec_ptr', 'output'),
+                                                          native, interpreted) if ours != theirs]
+
+        if differences:
+            raise RuntimeError("%s at %s differs from the interpreted code in: %s" % (self.name, address,
+                                                                                   ', '.join(differences)))
+
+        self.verified += 1
+
+        return next_ptr
+
+
+class SignatureRegistry(object):
+    """ Native routines keyed by the signature of the code they stand in for, installed on a VM wherever its memory
+    holds that code.
+    """
+
+    def __init__(self):
+        self.routines = []
+
+    def add(self, signature, routine):
+        """
+        :param RoutineSignature signature: The code routine stands in for
+        :param routine: callable(vm, registers, address) as Vm.register_native takes
+        """
+        self.routines.append((signature, routine))
+
+    def install(self, vm, verify=False):
+        """ Register every routine whose code vm's memory holds
+        :param Vm vm: The VM to register them on
+        :param bool verify: Check every call against the interpreted code, see VerifiedRoutine
+        :returns list of the names of the routines installed
+        """
+        installed = []
+
+        for signature, routine in self.routines:
+            if signature.matches(vm.memory):
+                vm.register_native(signature.address,
+                                   VerifiedRoutine(signature.name, routine) if verify else routine)
+                installed.append(signature.name)
+
+        return installed
+
+
+def library_registry():
+    """ The registry of challenge.bin's string routines, MEM_MAP with the PRINT_CHAR and PRINT_TOGGLED_CHAR callbacks
+    and PRINT_STRING. The callbacks are only ever called through MEM_MAP so they aren't registered themselves.
+    :returns SignatureRegistry
+    """
+    print_char = RoutineSignature('PRINT_CHAR', PRINT_CHAR, *PRINT_CHAR_CODE)
+    print_toggled_char = RoutineSignature('PRINT_TOGGLED_CHAR', PRINT_TOGGLED_CHAR, *PRINT_TOGGLED_CHAR_CODE)
+    mem_map = RoutineSignature('MEM_MAP', MEM_MAP, *MEM_MAP_CODE)
+    print_string = RoutineSignature('PRINT_STRING', PRINT_STRING, *PRINT_STRING_CODE)
+
+    registry = SignatureRegistry()
+    registry.add(mem_map, MemMap(mem_map, {
+        PRINT_CHAR: (print_char, print_characters),
+        PRINT_TOGGLED_CHAR: (print_toggled_char, print_toggled_characters),
+    }))
+    registry.add(print_string, PrintString(print_string))
+
+    return registry
+
+
+def install(vm):
+    """ Register the native routines on vm
+    :param Vm vm: The VM to register them on
+    """
+    vm.register_native(TELEPORTER_CONFIRMATION, TeleporterConfirmation())
+
+
+def confirms(energy_level):
+    """ Pool worker, whether the teleporter accepts energy_level in @7
+    """
+    a, b = TELEPORTER_ARGUMENTS
+    return TeleporterConfirmation().confirm(a, b, energy_level) == TELEPORTER_EXPECTED
+
+
+def search_energy_levels(processes=None, candidates=None):
+    """ Find every value of @7 the teleporter confirmation accepts, spread across a process pool
+    :param int processes: The size of the pool, the CPU count when None
+    :param candidates: The values to try, every non-zero 15-bit value when None
+    :returns list
+    """
+    if candidates is None:
+        candidates = xrange(1, MAX_INT)
+    candidates = list(candidates)
+
+    pool = Pool(processes)
+    try:
+        accepted = pool.map(confirms, candidates, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [candidate for candidate, ok in zip(candidates, accepted) if ok]
@@ -0,0 +1,286 @@
+"""
+    Execution profiler, counts instructions per address and opcode and attributes them to the functions that ran them.
+"""
+
+from vm import Decompiler, INSTRUCTIONS, MAX_MEMORY_ADDRESS, STOP_BUDGET_EXHAUSTED, execute_call, execute_ret, \
+    execute_native, execute_trap, execute_loop_header
+
+ROOT_FRAME = 'main'
+
+
+class Profiler(object):
+    """ Counts how often every address executes and keeps a shadow call stack of CALL targets, popped by RET and by
+    native routines returning the way a RET would. Instructions are credited to the stack that was active when they
+    ran, the per function self and cumulative counts and the collapsed stacks are all worked out from those totals.
+
+    With an interval of 1 run profiles every instruction through a Vm.run_until observer, which is exact but runs the
+    VM at about a third of its speed. With an interval above 1 it samples instead: the VM runs interval instructions at
+    a time without an observer, calls, returns and native routines decode to handlers that keep the shadow stack, and
+    each slice is credited to the address and stack it started at. Call counts stay exact, the address, self and
+    cumulative counts become estimates, and the VM runs at close to the speed of run_until.
+
+    The debugger subscribes step to the VM's step event instead, where the interval only thins the address counts. All
+    of these see instructions as Vm.decode decodes them, never fused.
+    """
+
+    def __init__(self, interval=1):
+        """
+        :param int interval: Profile every instruction when 1, otherwise sample every interval-th
+        """
+        self.interval = interval
+        self.address_counts = [0] * (MAX_MEMORY_ADDRESS + 1)
+        self.call_counts = {}
+        self.stack_counts = {}
+        self.stack = ()
+        self.returns = []
+        self.executed = 0
+        self.mark = 0
+        self.pending = None
+
+    def run(self, vm, max_instructions=None):
+        """ Run vm as Vm.run_for would, profiling everything it executes
+        :param Vm vm: The VM to profile
+        :param int max_instructions: The most instructions to execute, no limit when None
+        :returns str the reason it stopped, one of the STOP_ values
+        """
+        if self.interval == 1:
+            return vm.run_until(None, max_instructions, observe=self.observe)
+
+        return self.run_sampled(vm, max_instructions)
+
+    def run_sampled(self, vm, max_instructions=None):
+        """ Run vm in slices of interval instructions, sampling the address and stack each slice starts at
+        :returns str the reason it stopped, one of the STOP_ values
+        """
+        interval = self.interval
+        address_counts = self.address_counts
+        stack_counts = self.stack_counts
+        executed = 0
+        reason = STOP_BUDGET_EXHAUSTED
+
+        vm.profiler = self
+        vm.drop_decoded()
+
+        try:
+            while executed != max_instructions:
+                budget = interval if max_instructions is None else min(interval, max_instructions - executed)
+                address = vm.exec_ptr
+                stack = self.stack
+
+                reason = vm.run_until(None, budget)
+                executed += vm.last_executed
+
+                if vm.last_executed > 0:
+                    address_counts[address] += 1
+                    stack_counts[stack] = stack_counts.get(stack, 0) + vm.last_executed
+                    # the slice is credited already, calls and returns in it mustn't credit it again
+                    self.executed += vm.last_executed
+                    self.mark = self.executed
+
+                if reason != STOP_BUDGET_EXHAUSTED:
+                    break
+        finally:
+            vm.profiler = None
+            vm.drop_decoded()
+            vm.last_executed = executed
+
+        return reason
+
+    def observe(self, vm, address, record, next_ptr):
+        """ Vm.run_until observer, profiles the instruction that ran at address
+        """
+        self.executed += 1
+        self.address_counts[address] += 1
+
+        self.follow(record, next_ptr)
+
+    def step(self, vm):
+        """ Step event subscriber, profiles the instruction the VM is about to execute
+        :param Vm vm: The VM publishing the event
+        """
+        if self.pending is not None:
+            # where the previous instruction went is only known now
+            self.follow(self.pending, vm.exec_ptr)
+
+        self.executed += 1
+        if self.executed % self.interval == 0:
+            self.address_counts[vm.exec_ptr] += 1
+
+        record = vm.decoded[vm.exec_ptr]
+        if record is None:
+            record = vm.decode(vm.exec_ptr)
+        self.pending = record
+
+    def follow(self, record, next_ptr):
+        """ Push or pop the shadow stack for an instruction that was a call or a return. Breakpoints and loop headers
+        wrap the record of the instruction they are on.
+        :param tuple record: The decoded record the instruction ran from
+        :param int next_ptr: The address execution continued at
+        """
+        handler = record[0]
+        while handler is execute_trap or handler is execute_loop_header:
+            record = record[3]
+            handler = record[0]
+
+        if handler is execute_call:
+            self.called(next_ptr, record[1])
+        elif handler is execute_ret:
+            self.returned()
+        elif handler is execute_native:
+            self.native_returned(next_ptr)
+
+    def called(self, target, return_ptr):
+        """ A CALL to target ran, the profiled handlers call this while sampling
+        :param int target: The address called
+        :param int return_ptr: The address the call returns to
+        """
+        if self.executed > self.mark:
+            self.flush(self.executed)
+        self.stack += (target,)
+        self.returns.append(return_ptr)
+        self.call_counts[target] = self.call_counts.get(target, 0) + 1
+
+    def returned(self):
+        """ A RET ran, a RET without a matching CALL leaves the stack alone
+        """
+        if self.executed > self.mark:
+            self.flush(self.executed)
+        if self.stack:
+            self.stack = self.stack[:-1]
+            self.returns.pop()
+
+    def native_returned(self, next_ptr):
+        """ A native routine ran, it returned when it went back to where the call into it would have
+        :param int next_ptr: The address execution continued at
+        """
+        if len(self.returns) > 0 and next_ptr == self.returns[-1]:
+            self.returned()
+
+    def flush(self, executed):
+        if executed > self.mark:
+            self.stack_counts[self.stack] = self.stack_counts.get(self.stack, 0) + executed - self.mark
+            self.mark = executed
+
+    def opcode_counts(self, memory):
+        """ Counted instructions per opcode, by the opcode each address holds now
+        :param memory: The memory of the profiled VM
+        :returns dict
+        """
+        counts = {}
+        for address, count in enumerate(self.address_counts):
+            if count > 0:
+                name = INSTRUCTIONS.get(memory[address], str(memory[address]))
+                counts[name] = counts.get(name, 0) + count
+
+        return counts
+
+    def function_counts(self):
+        """ The calls, self and cumulative instruction counts of every called address. Cumulative counts include
+        everything run by the functions it called, a function is only counted once per stack when it recurses.
+        :returns dict target -> (calls, self, cumulative)
+        """
+        self.flush(self.executed)
+
+        own = {}
+        cumulative = {}
+        for stack, count in self.stack_counts.items():
+            if len(stack) == 0:
+                continue
+
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for target in set(stack):
+                cumulative[target] = cumulative.get(target, 0) + count
+
+        return dict((target, (calls, own.get(target, 0), cumulative.get(target, 0)))
+                    for target, calls in self.call_counts.items())
+
+    def collapsed_stacks(self):
+        """ The stacks in the collapsed format flamegraph.pl reads, one "main;F1458;F2125 count" line per stack
+        :returns list
+        """
+        self.flush(self.executed)
+
+        lines = []
+        for stack, count in sorted(self.stack_counts.items()):
+            frames = [ROOT_FRAME] + ['F%s' % target for target in stack]
+            lines.append('%s %s' % (';'.join(frames), count))
+
+        return lines
+
+    def save_collapsed(self, file):
+        with open(file, 'w') as fh:
+            fh.write('\n'.join(self.collapsed_stacks()) + '\n')
+
+    def report(self, memory, limit=20):
+        """ A text report of the hottest addresses, the opcode mix and the functions by cumulative count
+        :param memory: The memory of the profiled VM
+        :param int limit: How many addresses and functions to list
+        :returns str
+        """
+        decompiler = Decompiler()
+        lines = ['%s instructions' % self.executed, '', 'address      count  instruction']
+
+        hottest = sorted(enumerate(self.address_counts), key=lambda item: item[1], reverse=True)[:limit]
+        for address, count in hottest:
+            if count == 0:
+                break
+            _, instruction = decompiler.decompile_offset(address, memory)
+            lines.append('%s %12s  %s' % (str(address).zfill(5), count, instruction))
+
+        lines += ['', 'opcode       count']
+        for name, count in sorted(self.opcode_counts(memory).items(), key=lambda item: item[1], reverse=True):
+            lines.append('%-6s %11s' % (name, count))
+
+        lines += ['', 'function       calls         self   cumulative']
+        functions = sorted(self.function_counts().items(), key=lambda item: item[1][2], reverse=True)[:limit]
+        for target, (calls, own, cumulative) in functions:
+            lines.append('F%-5s %12s %12s %12s' % (target, calls, own, cumulative))
+
+        return '\n'.join(lines)
+
+
+class NgramCounter(object):
+    """ Counts how often every sequence of n consecutive opcodes executes, the data superinstructions are picked from.
+    Sequences are counted as they run, across jumps and calls, so a pair that is only adjacent in memory doesn't count
+    unless execution actually goes from one to the other.
+    """
+
+    def __init__(self, n=2):
+        """
+        :param int n: The length of the sequences to count
+        """
+        self.n = n
+        self.counts = {}
+        self.window = (None,) * n
+
+    def run(self, vm, max_instructions=None):
+        """ Run vm as Vm.run_for would, counting the opcode sequences it executes
+        :param Vm vm: The VM to run
+        :param int max_instructions: The most instructions to execute, no limit when None
+        :returns str the reason it stopped, one of the STOP_ values
+        """
+        return vm.run_until(None, max_instructions, observe=self.observe)
+
+    def observe(self, vm, address, record, next_ptr):
+        """ Vm.run_until observer, counts the sequence the instruction at address ends
+        """
+        self.window = window = self.window[1:] + (vm.memory[address],)
+        self.counts[window] = self.counts.get(window, 0) + 1
+
+    def most_common(self, limit=20):
+        """ The most executed sequences
+        :returns list of (names, count, share of all instructions)
+        """
+        total = float(sum(self.counts.values())) or 1.0
+        sequences = [(sequence, count) for sequence, count in self.counts.items() if None not in sequence]
+        sequences.sort(key=lambda item: item[1], reverse=True)
+
+        return [(tuple(INSTRUCTIONS.get(opcode, str(opcode)) for opcode in sequence), count, count / total)
+                for sequence, count in sequences[:limit]]
+
+    def report(self, limit=20):
+        lines = ['%-30s %12s %8s' % ('%s-gram' % self.n, 'count', 'share')]
+        for names, count, share in self.most_common(limit):
+            lines.append('%-30s %12s %7.2f%%' % (' '.join(names), count, share * 100))
+
+        return '\n'.join(lines)
@@ -26,6 +26,15 @@ class PubSub(object):
 
         self.subscribers[event].append(func)
 
+    def unsubscribe(self, event, func):
+        if event not in self.subscribers or func not in self.subscribers[event]:
+            return
+
+        self.subscribers[event].remove(func)
+
+    def has_subscribers(self, event):
+        return len(self.subscribers.get(event, [])) > 0
+
     def new_publisher(self):
         publisher = Publisher(manager=self)
         return publisher
@@ -50,6 +59,9 @@ class Publisher(object):
     def publish(self, event, *args, **kwargs):
         self.manager.publish(event, *args, **kwargs)
 
+    def has_subscribers(self, event):
+        return self.manager.has_subscribers(event)
+
 
 class PublisherAware(object):
     @property
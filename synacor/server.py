@@ -0,0 +1,262 @@
+"""
+    Line based TCP server that hosts a VM per connection, all of them sharing one process and one CPU.
+"""
+
+import os
+import time
+import socket
+import asyncore
+import asynchat
+
+from vm import Vm, Snapshot, STOP_HALTED
+from terminal import ScriptInput, CallbackSink, CaptureSink
+
+DEFAULT_QUANTUM = 10000
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_TICK = 0.05
+LISTEN_BACKLOG = 1024
+
+
+class Session(asynchat.async_chat):
+    """ One connected player and their VM. Lines received are queued as input, everything the VM writes out is pushed
+    straight back down the socket. A session that waits for input too long has its VM evicted to a snapshot on disk and
+    restored from it when the next line arrives.
+    """
+
+    def __init__(self, server, sock, number):
+        """
+        :param SessionServer server: The server the session belongs to
+        :param socket sock: The accepted connection
+        :param int number: The id of the session, used to name its snapshot
+        """
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.set_terminator('\n')
+
+        # output goes out a line at a time, don't let those small writes sit waiting on acknowledgements
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.server = server
+        self.number = number
+        self.partial = []
+        self.input = ScriptInput()
+        self.last_active = time.time()
+
+        # every session starts out at the first prompt, the server has already run the image up to it
+        snapshot, greeting = server.boot
+        self.vm = self.new_vm()
+        Snapshot.loads(snapshot, self.vm)
+        self.vm.waiting_for_input = True
+        self.push(greeting)
+
+    @property
+    def snapshot_file(self):
+        return os.path.join(self.server.snapshot_dir, 'session-%s.syns' % self.number)
+
+    @property
+    def evicted(self):
+        return self.vm is None
+
+    @property
+    def runnable(self):
+        """ Whether the VM has something to do, it either hasn't reached an IN yet or has input for it
+        """
+        if self.vm is None:
+            return False
+
+        return not self.vm.halt or (self.vm.waiting_for_input and len(self.input.lines) > 0)
+
+    def new_vm(self):
+        vm = Vm(compact=True)
+        vm.input_provider = self.input
+        vm.output.sink = CallbackSink(self.push)
+
+        return vm
+
+    def collect_incoming_data(self, data):
+        self.partial.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.partial).rstrip('\r')
+        self.partial = []
+
+        self.input.push(line)
+        self.last_active = time.time()
+
+        if self.evicted:
+            self.restore()
+
+    def run_quantum(self, quantum):
+        """ Run the VM for at most quantum instructions, closing the connection once the program halts for good
+        :param int quantum: The most instructions to run
+        :returns int the number of instructions run
+        """
+        if self.vm.run_for(quantum) == STOP_HALTED:
+            self.close_when_done()
+            self.server.remove(self)
+
+        return self.vm.last_executed
+
+    def evict(self):
+        """ Save the VM to a snapshot and drop it from memory
+        """
+        Snapshot.save(self.vm, self.snapshot_file)
+        self.vm = None
+
+    def restore(self):
+        """ Bring an evicted VM back from its snapshot
+        """
+        vm = self.new_vm()
+        Snapshot.load(self.snapshot_file, vm)
+        vm.waiting_for_input = True
+        os.remove(self.snapshot_file)
+
+        self.vm = vm
+
+    def handle_close(self):
+        self.close()
+        self.server.remove(self)
+
+        if self.evicted and os.path.exists(self.snapshot_file):
+            os.remove(self.snapshot_file)
+
+
+class SessionServer(asyncore.dispatcher):
+    """ Accepts connections and schedules their VMs round robin, each runnable session gets a quantum of instructions
+    per tick so a session stuck computing can't hold up the others. Sessions only take CPU while they have input to
+    work through.
+    """
+
+    def __init__(self, data, host='127.0.0.1', port=0, quantum=DEFAULT_QUANTUM, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 snapshot_dir='.', map=None):
+        """
+        :param data: The image every session starts from, anything Vm.load accepts
+        :param str host: The interface to listen on
+        :param int port: The port to listen on, any free port when 0
+        :param int quantum: The most instructions a session runs per tick
+        :param int idle_timeout: Seconds a session waits on input before it is evicted to disk
+        :param str snapshot_dir: Where evicted sessions are written
+        :param dict map: The asyncore socket map to use, a private one when None
+        """
+        self.map = map if map is not None else {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+
+        self.boot = self.boot_image(data)
+        self.quantum = quantum
+        self.idle_timeout = idle_timeout
+        self.snapshot_dir = snapshot_dir
+        self.sessions = []
+        self.session_count = 0
+        self.instruction_count = 0
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(LISTEN_BACKLOG)
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    @staticmethod
+    def boot_image(data):
+        """ Run the image up to its first IN, the self test and greeting are the same for every player
+        :returns tuple (snapshot, output)
+        """
+        sink = CaptureSink()
+
+        vm = Vm(compact=True)
+        vm.input_provider = None
+        vm.output.sink = sink
+        vm.load(data)
+        vm.run()
+
+        return Snapshot.dumps(vm), sink.getvalue()
+
+    def handle_accept(self):
+        # take every pending connection, a burst of clients would otherwise overflow the backlog
+        while True:
+            pair = self.accept()
+            if pair is None:
+                return
+
+            sock, _ = pair
+            self.session_count += 1
+            self.sessions.append(Session(self, sock, self.session_count))
+
+    def remove(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+
+    def tick(self, timeout=DEFAULT_TICK):
+        """ Handle socket events then give every runnable session one quantum. Only waits on the sockets for timeout
+        when no session has work to do.
+        """
+        runnable = [session for session in self.sessions if session.runnable]
+        asyncore.loop(timeout=0 if runnable else timeout, map=self.map, count=1)
+
+        for session in list(self.sessions):
+            if session.runnable:
+                self.instruction_count += session.run_quantum(self.quantum)
+
+        self.evict_idle()
+
+    def evict_idle(self):
+        now = time.time()
+        for session in self.sessions:
+            if not session.evicted and not session.runnable and now - session.last_active > self.idle_timeout:
+                session.evict()
+
+    def serve_forever(self, until=None):
+        """ Run ticks until until returns True, forever when None
+        :param until: callable()
+        """
+        while until is None or not until():
+            self.tick()
+
+
+class SimulatedClient(asynchat.async_chat):
+    """ A scripted player for load testing, sends its next command every time the game prompts for one
+    """
+
+    PROMPT = 'What do you do?\n'
+
+    def __init__(self, address, script, map):
+        """
+        :param tuple address: The (host, port) of the server
+        :param list script: The commands to send
+        :param dict map: The asyncore socket map to use
+        """
+        asynchat.async_chat.__init__(self, map=map)
+        self.set_terminator(self.PROMPT)
+
+        self.script = list(script)
+        self.received = []
+        self.prompts = 0
+        self.done = False
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def handle_connect(self):
+        pass
+
+    def collect_incoming_data(self, data):
+        self.received.append(data)
+
+    def found_terminator(self):
+        self.received.append(self.PROMPT)
+        self.prompts += 1
+
+        if self.prompts > len(self.script):
+            self.done = True
+            self.close()
+            return
+
+        self.push(self.script[self.prompts - 1] + '\n')
+
+    def handle_close(self):
+        self.done = True
+        self.close()
+
+    def output(self):
+        return ''.join(self.received)
@@ -0,0 +1,158 @@
+"""
+    Binary log of every instruction spy mode sees, written in large chunks and turned back into text offline.
+"""
+
+import struct
+import threading
+
+from Queue import Queue
+
+from vm import Decompiler, MAX_MEMORY_ADDRESS
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+# magic, version, record size
+HEADER = struct.Struct('<4sHH')
+MAGIC = 'SYNT'
+VERSION = 1
+
+# step, exec_ptr, the four words at exec_ptr, the registers before the instruction runs
+RECORD = struct.Struct('<IH4H8H')
+
+
+class SpyLogWriter(object):
+    """ Packs a fixed width record per instruction into a preallocated buffer and only writes to the file once the
+    buffer is full, from a thread of its own when background is set so the VM doesn't wait on the disk.
+    """
+
+    def __init__(self, file, buffer_size=DEFAULT_BUFFER_SIZE, background=False):
+        """
+        :param str file: Where to write the log
+        :param int buffer_size: Bytes to collect before writing, rounded down to whole records
+        :param bool background: Write from a thread of its own
+        """
+        self.fh = open(file, 'wb')
+        self.fh.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+        self.buffer = bytearray(max(buffer_size // RECORD.size, 1) * RECORD.size)
+        self.position = 0
+        self.queue = None
+        self.thread = None
+
+        if background:
+            self.queue = Queue()
+            self.thread = threading.Thread(target=self.drain)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, step, vm):
+        """ Log the instruction vm is about to execute
+        :param int step: The step count to log it under
+        :param Vm vm: The VM being spied on
+        """
+        memory = vm.memory
+        exec_ptr = vm.exec_ptr
+
+        if exec_ptr <= MAX_MEMORY_ADDRESS - 3:
+            words = (memory[exec_ptr], memory[exec_ptr + 1], memory[exec_ptr + 2], memory[exec_ptr + 3])
+        else:
+            words = tuple(memory[address] if address <= MAX_MEMORY_ADDRESS else 0
+                          for address in range(exec_ptr, exec_ptr + 4))
+
+        RECORD.pack_into(self.buffer, self.position, step, exec_ptr, *(words + tuple(vm.registers)))
+        self.position += RECORD.size
+
+        if self.position == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """ Hand everything buffered to the file or the writer thread
+        """
+        if self.position == 0:
+            return
+
+        data = str(self.buffer[:self.position])
+        self.position = 0
+
+        if self.queue is not None:
+            self.queue.put(data)
+        else:
+            self.fh.write(data)
+
+    def drain(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            self.fh.write(data)
+
+    def close(self):
+        """ Write out what is left and close the file, waiting for the writer thread to finish
+        """
+        self.flush()
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+        self.fh.close()
+
+
+class SpyLogReader(object):
+    """ Reads the records of a spy log back
+    """
+
+    def __init__(self, file):
+        """
+        :param str file: The log to read
+        :raises ValueError when file isn't a spy log of a supported version
+        """
+        self.file = file
+
+        with open(file, 'rb') as fh:
+            header = fh.read(HEADER.size)
+
+        if len(header) < HEADER.size or header[:4] != MAGIC:
+            raise ValueError("Not a spy log")
+
+        _, version, record_size = HEADER.unpack(header)
+        if version != VERSION or record_size != RECORD.size:
+            raise ValueError("Unsupported spy log version: " + str(version))
+
+    def records(self, address_from=0, address_to=MAX_MEMORY_ADDRESS, chunk_size=DEFAULT_BUFFER_SIZE):
+        """ Generator over the records executed between two addresses
+        :param int address_from: The lowest exec_ptr to include
+        :param int address_to: The highest exec_ptr to include
+        :returns generator of (step, exec_ptr, words, registers)
+        """
+        chunk_size = max(chunk_size // RECORD.size, 1) * RECORD.size
+        unpack_from = RECORD.unpack_from
+
+        with open(self.file, 'rb') as fh:
+            fh.seek(HEADER.size)
+
+            while True:
+                data = fh.read(chunk_size)
+                if len(data) < RECORD.size:
+                    return
+
+                for offset in xrange(0, len(data) - RECORD.size + 1, RECORD.size):
+                    fields = unpack_from(data, offset)
+                    if address_from <= fields[1] <= address_to:
+                        yield fields[0], fields[1], fields[2:6], fields[6:]
+
+    def lines(self, address_from=0, address_to=MAX_MEMORY_ADDRESS, registers=False):
+        """ Generator over the records as the "step:addr mnemonic" lines spy mode used to print
+        :param bool registers: Add the registers before each instruction to its line
+        """
+        decompiler = Decompiler()
+
+        for step, exec_ptr, words, values in self.records(address_from, address_to):
+            _, decompiled = decompiler.decompile_offset(0, words)
+            line = "%s:%s %s" % (step, str(exec_ptr).zfill(5), decompiled)
+
+            if registers:
+                line += " " + str(list(values))
+
+            yield line
@@ -0,0 +1,217 @@
+"""
+    Terminal layer of the VM, buffers what OUT writes and hands it to a sink and supplies the lines IN reads.
+"""
+
+import sys
+
+from Queue import Queue, Empty
+from StringIO import StringIO
+from collections import deque
+
+OUTPUT_BUFFER_LIMIT = 4096
+NEWLINE = 10
+
+
+class OutputBuffer(object):
+    """ Collects the characters written by OUT and passes them on to its sink a line at a time. The buffer is also
+    flushed once it reaches its limit and by the VM before an IN and whenever it stops running.
+    """
+
+    def __init__(self, sink=None, limit=OUTPUT_BUFFER_LIMIT):
+        """
+        :param sink: Where flushed output goes, standard out when None
+        :param int limit: The most characters to hold before flushing regardless of newlines
+        """
+        self.sink = sink if sink is not None else StdoutSink()
+        self.limit = limit
+        self.buffer = bytearray()
+
+    def write(self, value):
+        """ Buffer one character
+        :param int value: The ASCII code of the character
+        """
+        buffer = self.buffer
+        buffer.append(value)
+
+        if value == NEWLINE or len(buffer) >= self.limit:
+            self.flush()
+
+    def write_string(self, data):
+        """ Buffer a run of characters at once, flushing the same complete lines writing them one by one would
+        :param str data: The characters
+        """
+        buffer = self.buffer
+        buffer.extend(data)
+
+        if len(buffer) >= self.limit:
+            self.flush()
+        elif '\n' in data:
+            end = buffer.rindex('\n') + 1
+            self.sink.write(str(buffer[:end]))
+            del buffer[:end]
+
+    def flush(self):
+        """ Hand everything buffered to the sink
+        """
+        if len(self.buffer) == 0:
+            return
+
+        data = str(self.buffer)
+        del self.buffer[:]
+        self.sink.write(data)
+
+    def __copy__(self):
+        """ Copies share the sink but not the pending characters
+        """
+        output = OutputBuffer(self.sink, self.limit)
+        output.buffer = bytearray(self.buffer)
+
+        return output
+
+
+class StdoutSink(object):
+    """ Writes to whatever sys.stdout is at the time of the write
+    """
+
+    def write(self, data):
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+
+class FileSink(object):
+    """ Writes to a file, opened here when given a filename
+    """
+
+    def __init__(self, file):
+        """
+        :param file: A filename or an open file
+        """
+        self.owned = isinstance(file, basestring)
+        self.file = open(file, 'wb') if self.owned else file
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.flush()
+        if self.owned:
+            self.file.close()
+
+
+class CaptureSink(object):
+    """ Keeps everything written in memory
+    """
+
+    def __init__(self):
+        self.captured = StringIO()
+
+    def write(self, data):
+        self.captured.write(data)
+
+    def getvalue(self):
+        return self.captured.getvalue()
+
+    def take(self):
+        """ Returns everything captured so far and starts over
+        :returns str
+        """
+        value = self.captured.getvalue()
+        self.captured = StringIO()
+
+        return value
+
+
+class CallbackSink(object):
+    """ Passes every flushed chunk to a callable
+    """
+
+    def __init__(self, callback):
+        """
+        :param callback: callable(data)
+        """
+        self.callback = callback
+
+    def write(self, data):
+        self.callback(data)
+
+
+def as_line(text):
+    """ Returns text ending in exactly one newline, the way IN expects a command
+    """
+    return text.rstrip('\n') + '\n'
+
+
+class TerminalInput(object):
+    """ Reads lines from the terminal, blocking until one is entered
+    """
+
+    def read_line(self):
+        """ Returns the next line of input or None when there is none yet, which makes the VM stop at its IN.
+        Every provider implements this.
+        :returns str
+        """
+        return raw_input() + '\n'
+
+
+class ScriptInput(object):
+    """ Supplies the lines of a pre-recorded script, running out once they have all been read
+    """
+
+    def __init__(self, script=()):
+        """
+        :param script: A string of newline separated commands or a list of commands
+        """
+        if isinstance(script, basestring):
+            script = script.splitlines()
+
+        self.lines = deque(as_line(line) for line in script)
+
+    def read_line(self):
+        if len(self.lines) == 0:
+            return None
+
+        return self.lines.popleft()
+
+    def push(self, line):
+        """ Add a line to the end of the script
+        """
+        self.lines.append(as_line(line))
+
+    def __copy__(self):
+        return ScriptInput(list(self.lines))
+
+
+class GeneratorInput(object):
+    """ Supplies the lines a generator or any other iterable yields, a yielded None means nothing is available yet
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+
+    def read_line(self):
+        line = next(self.iterator, None)
+
+        if line is None:
+            return None
+
+        return as_line(line)
+
+
+class QueueInput(object):
+    """ Supplies lines put on a Queue, possibly from another thread, without ever waiting on it
+    """
+
+    def __init__(self, queue=None):
+        """
+        :param Queue queue: The queue to read from, a new one when None
+        """
+        self.queue = queue if queue is not None else Queue()
+
+    def read_line(self):
+        try:
+            return as_line(self.queue.get_nowait())
+        except Empty:
+            return None
+
+    def put(self, line):
+        self.queue.put(line)
@@ -2,14 +2,23 @@
     VM library that contains the bulk of the VM code.
 """
 
+import os
 import sys
+import copy
+import operator
+import shutil
+import struct
+import hashlib
+import tempfile
 
 import numpy
-from numpy import array, uint16
+from numpy import uint16
 
+from array import array
 from collections import deque
 
 from pubsub import PublisherAware, PubSub
+from terminal import OutputBuffer, TerminalInput
 
 INSTRUCTIONS = {
     0: 'halt',
@@ -60,6 +69,10 @@ IN = 20    # in a       - read a character from the terminal and write its ascii
            #              newline
 NOOP = 21  # noop       - no operation
 
+OPERAND_REGISTER = 'r'  # a register to write to, decoded to its index
+OPERAND_VALUE = 'v'     # a literal or a register to read from, registers are decoded to ~index
+OPERAND_ADDRESS = 'a'   # a jump target, decoded to a filtered memory address
+
 REGISTER_0 = 32768
 REGISTER_1 = 32769
 REGISTER_2 = 32770
@@ -76,6 +89,26 @@ MAX_VALID_VALUE = 32775
 MAX_MEMORY_ADDRESS = 32767
 TOROIDAL_MEMORY = True
 
+# why run_for and run_until returned
+STOP_HALTED = 'halted'
+STOP_WAITING_FOR_INPUT = 'waiting-for-input'
+STOP_BUDGET_EXHAUSTED = 'budget-exhausted'
+STOP_BREAKPOINT = 'breakpoint'
+STOP_TRAP = 'trap'
+
+# instructions run_sliced runs between slice events
+SLICE_SIZE = 10000
+
+# instructions that write to the register in their first operand
+REGISTER_WRITERS = frozenset([SET, POP, EQ, GT, ADD, MULT, MOD, AND, OR, NOT, RMEM, IN])
+
+# the most instructions a push or pop run is fused from
+MAX_FUSED_RUN = 8
+
+# watchpoint flags per memory address
+WATCH_READ = 1
+WATCH_WRITE = 2
+
 
 class Decompiler(object):
 
@@ -144,16 +177,362 @@ class Decompiler(object):
 
 class FileLoader(object):
     @staticmethod
-    def load(file):
+    def load(file, mapped=False):
+        """ Load an image from file
+        :param str file: The path of the image
+        :param bool mapped: Map the file copy-on-write instead of reading it, every call maps it again so each VM should
+            get its own MappedMemory while the OS shares the pages none of them wrote to
+        """
+        if mapped:
+            return MappedMemory(file)
+
         data = numpy.fromfile(file, dtype=uint16)
         return data
 
     @staticmethod
     def save(data, file):
-        converted_data = array(data, dtype=uint16)
+        if isinstance(data, MappedMemory):
+            data.save(file)
+            return
+
+        converted_data = numpy.array(data, dtype=uint16)
         converted_data.tofile(file)
 
 
+class MappedMemory(object):
+    """ VM memory on top of a private copy-on-write mapping of an image file. Addresses past the end of the image read
+    as zero. Writes are tracked per page so saving only has to write the pages that changed.
+    """
+
+    PAGE_SIZE = 2048  # words, 4 KB
+
+    def __init__(self, filename, size=MAX_MEMORY_ADDRESS + 1):
+        """
+        :param str filename: The image to map
+        :param int size: The number of addressable words
+        """
+        self.filename = filename
+        self.image = numpy.memmap(filename, dtype=uint16, mode='c')
+        self.image_size = len(self.image)
+        self.size = max(size, self.image_size)
+        self.tail = array('H', [0]) * (self.size - self.image_size)
+        self.dirty_pages = set()
+
+    def __getitem__(self, address):
+        if address < self.image_size:
+            return self.image.item(address)
+        return self.tail[address - self.image_size]
+
+    def __setitem__(self, address, value):
+        if address < self.image_size:
+            self.image[address] = value
+        else:
+            self.tail[address - self.image_size] = value
+
+        self.dirty_pages.add(address // MappedMemory.PAGE_SIZE)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.image.tolist() + self.tail.tolist())
+
+    def words(self, start, end):
+        """ Returns the words from start up to end packed as a uint16 string
+        """
+        packed = self.image[start:min(end, self.image_size)].tostring()
+
+        if end > self.image_size:
+            packed += self.tail[max(start - self.image_size, 0):end - self.image_size].tostring()
+
+        return packed
+
+    def tostring(self):
+        return self.words(0, self.size)
+
+    def save(self, file):
+        """ Write memory to file. Saving over the mapped image only writes the pages that changed, in place, after which
+        they count as unchanged. Other VMs mapping the same image may see those writes in the pages they haven't written
+        to themselves, save somewhere else to leave the image alone. Anywhere else gets a copy of the image with the
+        changed pages written over it, made next to file and renamed over it so a file mapped by other VMs is replaced
+        rather than written to.
+        :param str file: The path to save to
+        """
+        if os.path.exists(file) and os.path.samefile(file, self.filename):
+            with open(file, 'r+b') as fh:
+                self.write_pages(fh)
+            self.dirty_pages.clear()
+            return
+
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file)))
+        os.close(fd)
+
+        try:
+            shutil.copyfile(self.filename, temporary)
+            # mkstemp only gives the owner access
+            shutil.copymode(file if os.path.exists(file) else self.filename, temporary)
+
+            with open(temporary, 'r+b') as fh:
+                self.write_pages(fh)
+
+            os.rename(temporary, file)
+        except:
+            os.remove(temporary)
+            raise
+
+    def write_pages(self, fh):
+        """ Write the changed pages to their place in an open copy of the image
+        """
+        for page in sorted(self.dirty_pages):
+            start = page * MappedMemory.PAGE_SIZE
+            fh.seek(start * 2)
+            fh.write(self.words(start, min(start + MappedMemory.PAGE_SIZE, self.size)))
+
+
+class Snapshot(object):
+    """ Versioned binary format holding the complete state of a VM: halt flag, execution pointer, registers, stack,
+    pending input and memory. All words are little endian uint16.
+    """
+
+    MAGIC = 'SYNS'
+    VERSION = 1
+
+    # magic, version, halt, execution pointer, registers, stack size, input buffer size
+    HEADER = struct.Struct('<4sHBxH8HII')
+
+    @staticmethod
+    def dumps(vm):
+        """ Pack the state of vm into a snapshot string
+        :param Vm vm: The VM to snapshot
+        """
+        memory, registers, stack, exec_ptr = vm.pack_state()
+        input_buffer = ''.join(vm.input_buffer)
+
+        fields = (Snapshot.MAGIC, Snapshot.VERSION, int(vm.halt), exec_ptr) + struct.unpack('<8H', registers) + \
+            (len(stack) // 2, len(input_buffer))
+
+        return Snapshot.HEADER.pack(*fields) + stack + input_buffer + memory
+
+    @staticmethod
+    def loads(data, vm):
+        """ Restore the state in the snapshot string data into vm
+        :param str data: A snapshot from dumps
+        :param Vm vm: The VM to restore into
+        :raises ValueError when data isn't a snapshot of a supported version
+        """
+        if len(data) < Snapshot.HEADER.size or data[:4] != Snapshot.MAGIC:
+            raise ValueError("Not a VM snapshot")
+
+        fields = Snapshot.HEADER.unpack_from(data)
+        magic, version, halt, exec_ptr = fields[:4]
+        registers = fields[4:12]
+        stack_size, input_size = fields[12:]
+
+        if version != Snapshot.VERSION:
+            raise ValueError("Unsupported snapshot version: " + str(version))
+
+        offset = Snapshot.HEADER.size
+        stack = array('H', data[offset:offset + stack_size * 2])
+        offset += stack_size * 2
+        input_buffer = data[offset:offset + input_size]
+        offset += input_size
+        memory = array('H', data[offset:])
+
+        vm.memory = memory if vm.compact else memory.tolist()
+        vm.registers = array('H', registers) if vm.compact else list(registers)
+        vm.stack = Stack(stack) if vm.compact else deque(stack.tolist())
+        vm.input_buffer = deque(input_buffer)
+        vm.exec_ptr = exec_ptr
+        vm.halt = bool(halt)
+
+    @staticmethod
+    def save(vm, file):
+        with open(file, 'wb') as fh:
+            fh.write(Snapshot.dumps(vm))
+
+    @staticmethod
+    def load(file, vm):
+        with open(file, 'rb') as fh:
+            Snapshot.loads(fh.read(), vm)
+
+
+class PagedMemory(object):
+    """ VM memory split into fixed size pages that can be shared between forked VMs. A page is only copied the first
+    time a VM writes to it after a fork, so a fork costs a list of page references rather than a copy of memory.
+    """
+
+    PAGE_BITS = 8
+    PAGE_SIZE = 1 << PAGE_BITS
+    PAGE_MASK = PAGE_SIZE - 1
+
+    def __init__(self, pages):
+        """
+        :param list pages: array('H') pages of PAGE_SIZE words, owned by nobody else
+        """
+        self.pages = pages
+        self.owned = bytearray([1]) * len(pages)
+
+    @staticmethod
+    def from_words(words):
+        """ Build paged memory holding a copy of words
+        :param words: Anything Vm.pack_words accepts
+        """
+        packed = array('H', Vm.pack_words(words))
+        size = PagedMemory.PAGE_SIZE
+        return PagedMemory([packed[offset:offset + size] for offset in range(0, len(packed), size)])
+
+    def __getitem__(self, address):
+        return self.pages[address >> PagedMemory.PAGE_BITS][address & PagedMemory.PAGE_MASK]
+
+    def __setitem__(self, address, value):
+        index = address >> PagedMemory.PAGE_BITS
+
+        if not self.owned[index]:
+            self.pages[index] = self.pages[index][:]
+            self.owned[index] = 1
+
+        self.pages[index][address & PagedMemory.PAGE_MASK] = value
+
+    def __len__(self):
+        return len(self.pages) * PagedMemory.PAGE_SIZE
+
+    def __iter__(self):
+        for page in self.pages:
+            for word in page:
+                yield word
+
+    def tostring(self):
+        return ''.join(page.tostring() for page in self.pages)
+
+    def fork(self):
+        """ Returns memory sharing every page with this one, both sides copy a page before writing to it from now on
+        """
+        child = PagedMemory(list(self.pages))
+        child.owned = bytearray(len(self.pages))
+        self.owned = bytearray(len(self.pages))
+        return child
+
+
+class Stack(object):
+    """ A stack of uint16 words kept in a preallocated array with a top of stack index, it grows by doubling when full.
+    Supports the parts of the deque interface the VM and debugger use.
+    """
+
+    def __init__(self, values=(), size=64):
+        self.words = array('H', [0]) * max(size, len(values), 1)
+        self.top = 0
+
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        if self.top == len(self.words):
+            self.words.extend(array('H', [0]) * len(self.words))
+
+        self.words[self.top] = value
+        self.top += 1
+
+    def pop(self):
+        if self.top == 0:
+            raise IndexError("pop from an empty stack")
+
+        self.top -= 1
+        return self.words[self.top]
+
+    def tostring(self):
+        return self.words[:self.top].tostring()
+
+    def __copy__(self):
+        stack = Stack(size=len(self.words))
+        stack.words[:self.top] = self.words[:self.top]
+        stack.top = self.top
+        return stack
+
+    def validate_index(self, index):
+        if index < 0:
+            index += self.top
+
+        if index < 0 or index >= self.top:
+            raise IndexError("stack index out of range")
+
+        return index
+
+    def __getitem__(self, index):
+        return self.words[self.validate_index(index)]
+
+    def __setitem__(self, index, value):
+        self.words[self.validate_index(index)] = value
+
+    def __len__(self):
+        return self.top
+
+    def __iter__(self):
+        return iter(self.words[:self.top])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Stack(%s)" % (list(self))
+
+
+class AddressCache(dict):
+    """ Sparse stand in for the per address lists of decoded instructions, reading an address that was never stored
+    returns the default just like an empty slot in the list would. It can also sit on top of a base cache that is no
+    longer written to, which is how forked VMs share what they decoded before the fork. Entries are pulled up from the
+    base the first time they're read and writes, including clearing an entry, never reach the base.
+    """
+
+    # how many overlays a chain may hold before a fork flattens it
+    MAX_DEPTH = 8
+
+    def __init__(self, base=None, default=None):
+        """
+        :param base: A list or AddressCache to fall back on, it must not be written to from now on
+        :param default: The value of an address with no entry
+        """
+        super(AddressCache, self).__init__()
+        self.base = base
+        self.default = default
+        self.depth = base.depth + 1 if isinstance(base, AddressCache) else 1
+
+    def __missing__(self, address):
+        cache = self.base
+        while isinstance(cache, AddressCache) and not dict.__contains__(cache, address):
+            cache = cache.base
+
+        if isinstance(cache, AddressCache):
+            value = dict.__getitem__(cache, address)
+        elif cache is not None:
+            value = cache[address]
+        else:
+            value = self.default
+
+        if value:
+            self[address] = value
+        return value
+
+    def flatten(self):
+        """ A single overlay holding what this chain of overlays does, on top of the list or nothing at its bottom
+        :returns AddressCache
+        """
+        entries = {}
+        cache = self
+        while isinstance(cache, AddressCache):
+            for address, value in cache.iteritems():
+                # the entry nearest the top wins, cleared ones included
+                if address not in entries:
+                    entries[address] = value
+            cache = cache.base
+
+        flattened = AddressCache(cache, self.default)
+        flattened.update(entries)
+        return flattened
+
+
 class VmDebugger(object):
     """A debugger for the VM
     It works using a pubsub pattern, listening for when the VM emits specific events allowing the user to step through
@@ -183,7 +562,18 @@ class VmDebugger(object):
         'ssize': 'Z',
         'stack': 'S',
         'cstack': 'C',
-        'cbreako': 'O'
+        'cbreako': 'O',
+        'snapshot': 'x',
+        'restore': 'X',
+        'profile': 'f',
+        'report': 'R',
+        'listing': 'L',
+        'breakr': 'b',
+        'watch': 'w',
+        'unwatch': 'W',
+        'rstep': 'B',
+        'rcontinue': 'V',
+        'loops': 'y',
     }
 
     COMMAND_OPTS_COUNT = {
@@ -199,7 +589,7 @@ class VmDebugger(object):
         'registers': 0,
         'resume': 0,
         'quit': 0,
-        'spy': 0,
+        'spy': (0, 1),
         'breaks': 1,
         'save': 1,
         'load': 1,
@@ -208,10 +598,41 @@ class VmDebugger(object):
         'stack': 0,
         'cstack': 0,
         'cbreako': 1,
+        'snapshot': 1,
+        'restore': 1,
+        'profile': 0,
+        'report': (0, 1),
+        'listing': 1,
+        'breakr': 4,
+        'watch': (2, 3),
+        'unwatch': (1, 2),
+        'rstep': (0, 1),
+        'rcontinue': 0,
+        'loops': 0,
     }
 
     COMMAND_SHORTCUTS = {v: k for k, v in COMMANDS.items()}
 
+    # instructions cstack lists
+    TRACE_TAIL = 20
+
+    SPY_LOG = 'spy.log'
+
+    CONDITION_OPERATORS = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge,
+    }
+
+    WATCH_KINDS = {
+        'r': WATCH_READ,
+        'w': WATCH_WRITE,
+        'rw': WATCH_READ | WATCH_WRITE,
+    }
+
     REGISTER_MAP = {
         0: REGISTER_0,
         1: REGISTER_1,
@@ -260,11 +681,13 @@ class VmDebugger(object):
         self.step_continue = False
         self.resume = False
         self.spy = False
+        self.spy_log = None
         self.break_step_count = None
-        self.offset_break_points = {}
         self._decompiler = None
-        self.call_stack = deque()
         self.output_file = None
+        self.profiler = None
+        self.profiling = False
+        self.loop_detector = None
 
         if output_file is not None:
             self.output_file = open(output_file, 'w+')
@@ -274,12 +697,23 @@ class VmDebugger(object):
 
         self.vm = vm
 
+        # the history module builds on this one
+        from history import TraceBuffer
+
+        self.trace = TraceBuffer()
+        self.trace.attach(vm)
+
         self.pubsub.subscribe('run-start', self.run_start)
-        self.pubsub.subscribe('step', self.step)
         self.pubsub.subscribe('run-end', self.run_end)
+        self.pubsub.subscribe('trap', self.trap)
+        self.pubsub.subscribe('loop', self.loop)
+        self.pubsub.subscribe('slice', self.slice)
+        self.attach()
 
     def print_out(self, string):
         if self.output_file is None:
+            # keep what the VM has written so far ahead of the debugger's own lines
+            self.vm.output.flush()
             print string
         else:
             self.output_file.write(str(string) + '\n')
@@ -288,34 +722,78 @@ class VmDebugger(object):
     def run(self):
         self.vm.run()
 
+    def attach(self):
+        """ Start listening to every step of the VM, switching it over to its instrumented loop
+        """
+        if self.step not in self.pubsub.subscribers.get('step', []):
+            self.pubsub.subscribe('step', self.step)
+        self.vm.interrupt()
+
+    def detach(self):
+        """ Stop listening to the steps of the VM so it runs in slices, see Vm.run_sliced. The trace only takes
+        snapshots there, so those instructions can be stepped back over but not listed.
+        """
+        self.pubsub.unsubscribe('step', self.step)
+        self.vm.interrupt()
+
+    def slice(self, vm, executed):
+        self.step_counter += executed
+        self.trace.advance(vm, executed)
+
     def run_start(self, vm):
         pass
 
     def run_end(self, vm):
-        pass
+        if self.spy:
+            # the writer thread would be lost with the process
+            self.command_spy()
 
     def step(self, vm):
         self.step_counter += 1
 
-        if self.step_counter == self.break_step_count or self.vm.exec_ptr in self.offset_break_points:
+        if self.step_counter == self.break_step_count:
             self.resume = False
 
         if self.spy:
-            memory_address = self.format_memory_address(self.vm.exec_ptr)
-            offset, decompiled = self.decompiler.decompile_offset(self.vm.exec_ptr, self.vm.memory)
-            self.print_out("%s:%s %s" % (str(self.step_counter), memory_address, decompiled))
+            self.spy_log.write(self.step_counter, self.vm)
+
+        if not self.resume:
+            while not self.step_continue:
+                user_input = self.get_input()
+                self.parse_input(user_input)
+            self.step_continue = False
 
-        self.call_stack.append(self.vm.exec_ptr)
+        # after the prompt, which may have stepped back to another instruction
+        self.trace.record(self.vm)
 
-        if self.resume:
+    def trap(self, vm, address, reason):
+        """ A breakpoint or watchpoint triggered, prompt before the instruction at address runs. Breakpoints and
+        watchpoints live in the VM itself, so while resumed the debugger isn't called for anything else.
+        """
+        if not self.resume:
+            # already prompting before every instruction
             return
 
+        self.print_out("%s: %s" % (self.format_memory_address(address), reason))
+        self.resume = False
+
+        # count the instruction about to run as step does while prompting, it's counted again once it has run
+        self.step_counter += 1
         while not self.step_continue:
             user_input = self.get_input()
             self.parse_input(user_input)
         self.step_continue = False
+        self.step_counter -= 1
+
+        if not self.resume:
+            # step from the next instruction on
+            self.attach()
+
+    def loop(self, vm, report):
+        self.print_out(str(report))
 
     def get_input(self):
+        self.vm.output.flush()
         user_input = raw_input("[%s:%s]> " % (str(self.step_counter),
                                               self.format_memory_address(self.vm.exec_ptr)))
         return user_input
@@ -363,10 +841,53 @@ class VmDebugger(object):
         self.print_out(self.vm.stack)
 
     def command_cstack(self):
-        """ Output the call stack
+        """ Output the last instructions traced along with the register each one wrote and the value it had before
+        """
+        for step, exec_ptr, opcode, register, value in self.trace.tail(VmDebugger.TRACE_TAIL):
+            _, decompiled = self.decompiler.decompile_offset(exec_ptr, self.vm.memory)
+            change = " (@%s was %s)" % (register, value) if register is not None else ""
+            self.print_out("%s:%s %s%s" % (step + self.trace_offset(), self.format_memory_address(exec_ptr),
+                                           decompiled, change))
+
+    def command_rstep(self, count=1):
+        """ Step back count instructions, as far back as the trace goes
         """
-        for memory_offset in self.call_stack:
-            self.decompiler.decompile_offset(memory_offset, self.vm.memory)
+        target = self.trace.steps - int(count)
+        if target < self.trace.oldest:
+            self.print_out("Can only step back %s instructions" % (self.trace.steps - self.trace.oldest))
+            return
+
+        self.rewind(target)
+
+    def command_rcontinue(self):
+        """ Step back to the last time execution reached a breakpoint whose condition held, or as far back as the trace
+        goes when there wasn't one. Only the instructions stepped through are searched, not those run while resumed.
+        """
+        breakpoints = self.vm.breakpoints
+        first = max(self.trace.oldest, self.trace.steps - self.trace.size, self.trace.first_entry)
+
+        for step in range(self.trace.steps - 1, first - 1, -1):
+            exec_ptr = self.trace.entry(step)[0]
+            if exec_ptr in breakpoints:
+                self.rewind(step)
+
+                condition = breakpoints[exec_ptr]
+                if condition is None or condition(self.vm):
+                    self.print_out("%s: breakpoint" % self.format_memory_address(exec_ptr))
+                    return
+
+        self.rewind(self.trace.oldest)
+
+    def rewind(self, target):
+        """ Put the VM back to before traced instruction target, the prompt then carries on from there
+        """
+        self.step_counter -= self.trace.steps - target
+        self.trace.rewind(self.vm, target)
+
+    def trace_offset(self):
+        """ What to add to a trace step to number it the way step_counter does
+        """
+        return self.step_counter - self.trace.steps
 
     def command_breaks(self, step_count):
         """ Sets a break point at a specific step count
@@ -376,24 +897,138 @@ class VmDebugger(object):
     def command_breako(self, offset):
         """ Sets a break point at a specific execution offset
         """
-        self.offset_break_points[int(offset)] = True
+        self.vm.set_breakpoint(int(offset))
 
     def command_cbreako(self, offset):
-        if offset in self.offset_break_points:
-            del(self.offset_break_points[offset])
+        self.vm.clear_breakpoint(int(offset))
+
+    def command_breakr(self, offset, register, comparison, value):
+        """ Sets a break point at an execution offset that only triggers while a register compares to a value, for
+        example: breakr 5489 @7 != 0
+        """
+        if comparison not in VmDebugger.CONDITION_OPERATORS:
+            self.print_out("Invalid comparison, must be one of %s" % ' '.join(sorted(VmDebugger.CONDITION_OPERATORS)))
+            return
+
+        compare = VmDebugger.CONDITION_OPERATORS[comparison]
+        index = int(self.parse_register_annotation(register)) - REGISTER_0
+        value = int(value)
+
+        self.vm.set_breakpoint(int(offset), lambda vm: compare(vm.registers[index], value))
+
+    def command_watch(self, kind, address_from, address_to=None):
+        """ Break before an RMEM (r), WMEM (w) or either (rw) touches memory between address_from and address_to
+        """
+        if kind not in VmDebugger.WATCH_KINDS:
+            self.print_out("Invalid watch kind, must be one of r, w or rw")
+            return
+
+        address_to = address_to if address_to is not None else address_from
+        self.vm.watch(int(address_from), int(address_to), VmDebugger.WATCH_KINDS[kind])
+
+    def command_unwatch(self, address_from, address_to=None):
+        address_to = address_to if address_to is not None else address_from
+        self.vm.unwatch(int(address_from), int(address_to))
 
     def command_save(self, filename):
         FileLoader.save(self.vm.memory, filename)
 
     def command_load(self, filename):
         self.vm.load(FileLoader.load(filename))
+        self.trace.restart()
+
+    def command_snapshot(self, filename):
+        """ Saves the complete state of the VM so it can be resumed with restore
+        """
+        Snapshot.save(self.vm, filename)
+
+    def command_restore(self, filename):
+        """ Restores the complete state of the VM from a snapshot
+        """
+        Snapshot.load(filename, self.vm)
+        self.trace.restart()
 
     def command_resume(self):
         self.resume = True
         self.step_continue = True
 
-    def command_spy(self):
+        # with nothing left that could stop or report on a step there is no reason to keep paying for them
+        if self.break_step_count is None and not self.spy:
+            self.detach()
+
+    def command_profile(self):
+        """ Toggle profiling, starting a new profile each time it is turned on
+        """
+        if self.profiling:
+            self.pubsub.unsubscribe('step', self.profiler.step)
+            self.profiling = False
+            self.print_out("Profiling stopped")
+            return
+
+        # the profiler module builds on this one
+        from profiler import Profiler
+
+        self.profiler = Profiler()
+        self.pubsub.subscribe('step', self.profiler.step)
+        self.profiling = True
+        self.print_out("Profiling started")
+
+    def command_report(self, filename=None):
+        """ Print the profile report, writing the collapsed stacks to filename when given
+        """
+        if self.profiler is None:
+            self.print_out("Nothing profiled yet")
+            return
+
+        self.print_out(self.profiler.report(self.vm.memory))
+
+        if filename is not None:
+            self.profiler.save_collapsed(filename)
+
+    def command_listing(self, filename):
+        """ Write the listing of memory as it is now to filename. The listing is built on first use and from then on
+        only the code the program has rewritten since is disassembled again.
+        """
+        if self.vm.listing is None:
+            # the disassembler module builds on this one
+            from disassembler import LiveListing
+
+            LiveListing(self.vm)
+
+        self.vm.listing.save(filename)
+
+    def command_loops(self):
+        """ Toggle reporting loops that run for a long time, printing every loop found so far when turned off
+        """
+        if self.loop_detector is not None:
+            self.loop_detector.detach(self.vm)
+            self.print_out(self.loop_detector.summary())
+            self.loop_detector = None
+            return
+
+        # the loops module builds on this one
+        from loops import LoopDetector
+
+        self.loop_detector = LoopDetector()
+        self.loop_detector.attach(self.vm)
+        self.print_out("Detecting loops")
+
+    def command_spy(self, filename=SPY_LOG):
+        """ Toggle logging every instruction to filename, a binary log that synacor-spy.py turns into text
+        """
+        if self.spy:
+            self.spy_log.close()
+            self.spy_log = None
+            self.spy = False
+            self.print_out("Spy log closed")
+            return
+
+        # the spy log module builds on this one
+        from spylog import SpyLogWriter
+
+        self.spy_log = SpyLogWriter(filename, background=True)
         self.spy = True
+        self.print_out("Spying into %s" % filename)
 
     def command_continue(self):
         """ Just allows the debugger to continue to the next step
@@ -540,6 +1175,17 @@ class Vm(PublisherAware):
     @memory.setter
     def memory(self, data):
         self._memory = data
+        self._decoded = self.new_address_cache(len(data) + 1)
+        self._fused = self.new_address_cache(len(data) + 1)
+        self._fusion_owners = AddressCache(default=frozenset())
+        self.signature_matches = {}
+        self._signature_owners = AddressCache(default=frozenset())
+
+    @property
+    def decoded(self):
+        """ The per address cache of decoded instruction records, None where nothing is decoded
+        """
+        return self._decoded
 
     @property
     def stack(self):
@@ -573,208 +1219,686 @@ class Vm(PublisherAware):
     def input_buffer(self, value):
         self._input_buffer = value
 
-    def __init__(self):
+    def __init__(self, compact=False, fuse=False):
+        """
+        :param bool compact: Keep memory, registers and the stack in uint16 arrays and the decoded instructions in a
+            sparse cache instead of Python lists, trading some speed for a far smaller footprint per VM
+        :param bool fuse: Have run fuse common instruction sequences into superinstructions, see decode_fused
+        """
         super(Vm, self).__init__()
 
+        self.compact = compact
+        self.fuse = fuse
         self.halt = False
-        self._memory = [] + [0] * (MAX_MEMORY_ADDRESS + 1)
-        self._stack = deque()
+        self._memory = self.new_memory([])
+        self._decoded = self.new_address_cache(MAX_MEMORY_ADDRESS + 2)
+        self._fused = self.new_address_cache(MAX_MEMORY_ADDRESS + 2)
+        # address -> frozenset of the addresses of the superinstructions fused from the word there
+        self._fusion_owners = AddressCache(default=frozenset())
+        # routine signature -> whether memory holds its code, see remember_signature
+        self.signature_matches = {}
+        # address -> frozenset of the signatures whose code covers the word there
+        self._signature_owners = AddressCache(default=frozenset())
+        self._stack = Stack() if compact else deque()
         self._input_buffer = deque()
-        self._registers = [
-            0,
-            0,
-            0,
-            0,
-            0,
-            0,
-            0,
-            0
-        ]
+        self._registers = self.new_registers()
+
+        self.output = OutputBuffer()
+        self.input_provider = TerminalInput()
 
         self._exec_ptr = 0
+        self._interrupted = False
+
+        self.native_routines = {}
+
+        # a LiveListing told about every word written, None when nothing is following memory
+        self.listing = None
+
+        # address -> condition, None for a breakpoint that always triggers
+        self.breakpoints = {}
+        # WATCH_ flags per address, None while nothing is watched so RMEM and WMEM decode to their plain handlers
+        self.watch_flags = None
+        # a LoopDetector sampled by every backward jump taken, None to decode jumps to their plain handlers
+        self.loop_detector = None
+        # a Profiler told about every call and return while it samples, None to decode them to their plain handlers
+        self.profiler = None
+
+        # while run_sliced runs a slice traps stop it instead of being published, the one pending is kept here
+        self._defer_traps = False
+        self._deferred_trap = None
+        # the address whose trap is let through once, for running the instruction a deferred trap stopped at
+        self._trap_bypass = None
+
+        # set when an IN found no input, the VM stops at that IN and picks up from it on the next run
+        self.waiting_for_input = False
+        self.last_executed = 0
 
     def run(self):
-        """ Executes the program loaded into memory one instruction at a time.
+        """ Executes the program loaded into memory one instruction at a time. While anything is subscribed to the step
+        event it is published before every instruction, otherwise while anything is subscribed to the slice event the
+        instructions run in slices, see run_sliced, and otherwise a loop without any per-step hook is used.
         """
 
         self.publisher.publish('run-start', vm=self)
 
         self.halt = False
+        self.waiting_for_input = False
+
+        try:
+            while not self.halt:
+                self._interrupted = False
+
+                if self.publisher.has_subscribers('step'):
+                    self.run_instrumented()
+                elif self.publisher.has_subscribers('slice'):
+                    self.run_sliced()
+                else:
+                    self.run_fast()
+        finally:
+            self.output.flush()
+
+        self.publisher.publish('run-end', vm=self)
 
-        while not self.halt:
+    def run_instrumented(self):
+        """ Executes instructions, publishing the step event before each one, until halted or interrupted.
+        """
+        while not self.halt and not self._interrupted:
             self.publisher.publish('step', vm=self)
 
-            if self.exec_ptr > (len(self.memory) - 1):
-                raise OverflowError("Execution pointer has overran memory: " + str(self.exec_ptr))
+            exec_ptr = self._exec_ptr
 
-            a = b = c = None
+            if exec_ptr > (len(self.memory) - 1):
+                raise OverflowError("Execution pointer has overran memory: " + str(exec_ptr))
 
-            instruction = self.memory[self.exec_ptr]
+            record = self._decoded[exec_ptr]
+            if record is None:
+                record = self.decode(exec_ptr)
 
-            if instruction == HALT:
-                self.halt = True
-                continue
-            elif instruction == SET:
-                a = self.get_a_param()
-                b = self.get_b_param()
+            self._exec_ptr = record[0](self, self._registers, record)
 
-                self.instruction_set(a, b)
+    def run_sliced(self):
+        """ Executes instructions with run_until in slices of at most SLICE_SIZE, publishing the slice event with the
+        number executed after each one, until halted or interrupted. A trap ends the slice it happens in, so it is
+        published with every instruction before it accounted for, and the instruction that trapped then runs on its own.
+        This is how the debugger keeps its trace going while resumed.
+        """
+        while not self.halt and not self._interrupted:
+            self._defer_traps = True
+            try:
+                reason = self.run_until(None, SLICE_SIZE)
+            finally:
+                self._defer_traps = False
+
+            self.publisher.publish('slice', vm=self, executed=self.last_executed)
+
+            if reason == STOP_TRAP:
+                address, why = self._deferred_trap
+                self._deferred_trap = None
+
+                if self.trap(address, why) == address and not self.halt:
+                    self._trap_bypass = address
+                    try:
+                        self.run_until(None, 1)
+                    finally:
+                        self._trap_bypass = None
+
+                    self.publisher.publish('slice', vm=self, executed=self.last_executed)
+
+    def run_fast(self):
+        """ Executes instructions without publishing anything until halted or interrupted. Nothing outside of the
+        instructions can touch the VM while this runs so its state is kept in locals. With fuse set this is the only
+        loop that runs superinstructions, the others execute exactly one instruction per record.
+        """
+        registers = self._registers
+        decoded = self._fused if self.fuse else self._decoded
+        decode = self.decode_fused if self.fuse else self.decode
+        exec_ptr = self._exec_ptr
+
+        try:
+            while not self.halt and not self._interrupted:
+                record = decoded[exec_ptr]
+                if record is None:
+                    record = decode(exec_ptr)
+
+                exec_ptr = record[0](self, registers, record)
+        finally:
+            self._exec_ptr = exec_ptr
+
+    def run_for(self, max_instructions):
+        """ Executes at most max_instructions instructions without publishing anything. Like run_until it can be called
+        again to carry on exactly where it stopped, which is how a scheduler shares the CPU between many VMs. It runs
+        one instruction at a time as run_until does.
+        :param int max_instructions: The most instructions to execute
+        :returns str the reason it stopped, one of the STOP_ values
+        :raises ValueError when max_instructions is negative
+        """
+        return self.run_until(None, max_instructions)
+
+    def run_until(self, stop, max_instructions=None, observe=None):
+        """ Executes instructions without publishing anything until stop says so, the program halts or waits for
+        input or the budget runs out. The instruction about to run is never checked against stop, so running again
+        after a breakpoint moves past it. The number of instructions executed is left in last_executed.
+
+        Instructions are always decoded and run one at a time, for JitVm too and with fuse set, as counting them and
+        stopping between any two needs. The compiled blocks and superinstructions are only used by run.
+        :param stop: A set of addresses to stop at or a predicate called with the vm after every instruction, which
+            is much slower than addresses. None to only stop for the other reasons.
+        :param int max_instructions: The most instructions to execute, no limit when None
+        :param observe: callable(vm, address, record, next_ptr) called after every instruction that ran with the record
+            it was run from and the address execution continues at, which is how the profilers see every instruction
+            without a loop of their own. None to run without it.
+        :returns str the reason it stopped, one of the STOP_ values
+        :raises ValueError when max_instructions is negative
+        """
+        if max_instructions is not None and max_instructions < 0:
+            raise ValueError("Invalid instruction budget: " + str(max_instructions))
 
-                self.exec_ptr += 3
-            elif instruction == PUSH:
-                a = self.get_a_param()
+        predicate = stop if callable(stop) else None
+        addresses = frozenset(stop) if stop is not None and predicate is None else frozenset()
+        limit = max_instructions if max_instructions is not None else -1
 
-                self.instruction_push(a)
-                self.exec_ptr += 2
-            elif instruction == POP:
-                a = self.get_a_param()
+        registers = self._registers
+        decoded = self._decoded
+        decode = self.decode
+        exec_ptr = self._exec_ptr
+        executed = 0
+        reason = STOP_BUDGET_EXHAUSTED
+        interrupted = False
 
-                self.instruction_pop(a)
+        self.halt = False
+        self.waiting_for_input = False
+
+        try:
+            while executed != limit:
+                address = exec_ptr
+                record = decoded[address]
+                if record is None:
+                    record = decode(address)
+
+                exec_ptr = record[0](self, registers, record)
+                executed += 1
+
+                if self.halt:
+                    if self.waiting_for_input:
+                        # the IN it stopped at didn't run
+                        executed -= 1
+                        reason = STOP_WAITING_FOR_INPUT
+                    else:
+                        reason = STOP_HALTED
+                        if observe is not None:
+                            observe(self, address, record, exec_ptr)
+                    break
+
+                if self._interrupted:
+                    self._interrupted = False
+
+                    if self._deferred_trap is not None:
+                        # the instruction that trapped didn't run
+                        executed -= 1
+                        reason = STOP_TRAP
+                        break
+
+                    # nothing else stops run_until, pick up what a trap subscriber swapped in and leave the interrupt
+                    # to whatever loop called it
+                    interrupted = True
+                    registers = self._registers
+                    decoded = self._decoded
+
+                if observe is not None:
+                    observe(self, address, record, exec_ptr)
+
+                if exec_ptr in addresses:
+                    reason = STOP_BREAKPOINT
+                    break
+
+                if predicate is not None:
+                    self._exec_ptr = exec_ptr
+                    stopped = predicate(self)
+                    exec_ptr = self._exec_ptr
+
+                    if stopped:
+                        reason = STOP_BREAKPOINT
+                        break
+        finally:
+            self._exec_ptr = exec_ptr
+            self.last_executed = executed
+            self._interrupted = self._interrupted or interrupted
+            self.output.flush()
+
+        return reason
+
+    def interrupt(self):
+        """ Makes a running VM return to run at the next instruction boundary so it can pick its loop again, used when
+        the step subscribers change mid run. Does nothing to a VM that isn't running.
+        """
+        self._interrupted = True
 
-                self.exec_ptr += 2
-            elif instruction == EQ:
-                a = self.get_a_param()
-                b = self.get_b_param()
-                c = self.get_c_param()
+    def load(self, data):
+        """ Takes in parsed binary data and loads it into memory
+        :param data: []
+        """
+        if len(data) == 0:
+            raise ValueError("No data to load")
+        elif len(data) > MAX_MEMORY_ADDRESS + 1:
+            raise OverflowError("Not enough memory to load program.")
 
-                self.instruction_eq(a, b, c)
+        self.halt = False
+        self.memory = self.new_memory(data)
+        self.registers = self.new_registers()
+        self.exec_ptr = 0
 
-                self.exec_ptr += 4
-            elif instruction == GT:
-                a = self.get_a_param()
-                b = self.get_b_param()
-                c = self.get_c_param()
+    def new_memory(self, data):
+        """ Builds a full sized memory holding data followed by zeros, a MappedMemory is used as is.
+        :param data: The words to start memory with
+        """
+        if isinstance(data, MappedMemory):
+            return data
 
-                self.instruction_gt(a, b, c)
+        count = (MAX_MEMORY_ADDRESS + 1) - len(data)
 
-                self.exec_ptr += 4
-            elif instruction == JMP:
-                a = self.get_a_param()
+        if not self.compact:
+            return [int(n) for n in data] + [0] * count
 
-                self.instruction_jmp(a)
-            elif instruction == JT:
-                a = self.get_a_param()
-                b = self.get_b_param()
+        if isinstance(data, numpy.ndarray):
+            memory = array('H', data.astype(uint16).tostring())
+        else:
+            memory = array('H', data)
 
-                self.instruction_jt(a, b)
-            elif instruction == JF:
-                a = self.get_a_param()
-                b = self.get_b_param()
+        return memory + array('H', [0]) * count
 
-                self.instruction_jf(a, b)
-            elif instruction == ADD:
-                a = self.get_a_param()
-                b = self.get_b_param()
-                c = self.get_c_param()
+    def new_registers(self):
+        if self.compact:
+            return array('H', [0]) * 8
 
-                self.instruction_add(a, b, c)
+        return [
+            0,
+            0,
+            0,
+            0,
+            0,
+            0,
+            0,
+            0
+        ]
 
-                self.exec_ptr += 4
-            elif instruction == MULT:
-                a = self.get_a_param()
-                b = self.get_b_param()
-                c = self.get_c_param()
+    def new_address_cache(self, size):
+        """ Builds an empty per address cache, a list in the default mode or a sparse AddressCache in compact mode.
+        :param int size: The number of addresses the cache covers
+        """
+        if self.compact:
+            return AddressCache()
 
-                self.instruction_mult(a, b, c)
+        return [None] * size
 
-                self.exec_ptr += 4
-            elif instruction == MOD:
-                a = self.get_a_param()
-                b = self.get_b_param()
-                c = self.get_c_param()
+    def fork(self):
+        """ Returns a copy of this VM that shares its memory pages copy-on-write. Memory is switched over to PagedMemory
+        on the first fork, after that a fork only copies the page table, the registers, the stack and pending input.
+        Decoded instructions are shared through AddressCache overlays.
+        :returns Vm
+        """
+        if not isinstance(self._memory, PagedMemory):
+            # same words so the decoded instructions are still good, bypass the setter to keep them
+            self._memory = PagedMemory.from_words(self._memory)
+
+        child = copy.copy(self)
+        child._pubsub_publisher = None
+        child._interrupted = False
+        child._memory = self._memory.fork()
+        child._decoded, self._decoded = Vm.fork_cache(self._decoded)
+        child._fused, self._fused = Vm.fork_cache(self._fused)
+        child._fusion_owners, self._fusion_owners = Vm.fork_cache(self._fusion_owners)
+        child.signature_matches = dict(self.signature_matches)
+        child._signature_owners, self._signature_owners = Vm.fork_cache(self._signature_owners)
+        child._registers = self._registers[:]
+        child._stack = copy.copy(self._stack)
+        child._input_buffer = deque(self._input_buffer)
+        child.output = copy.copy(self.output)
+        child.input_provider = copy.copy(self.input_provider)
+        child.native_routines = dict(self.native_routines)
+        # the listing follows the parent's memory only
+        child.listing = None
+        child.breakpoints = dict(self.breakpoints)
+        child.watch_flags = bytearray(self.watch_flags) if self.watch_flags is not None else None
+
+        return child
+
+    def pack_state(self):
+        """ Returns the memory, registers and stack packed into uint16 strings along with the execution pointer. In
+        compact mode these are straight copies of the underlying buffers rather than a walk over Python lists.
+        :returns tuple (memory, registers, stack, exec_ptr)
+        """
+        return (Vm.pack_words(self.memory), Vm.pack_words(self.registers), Vm.pack_words(self.stack),
+                self.exec_ptr)
 
-                self.instruction_mod(a, b, c)
+    def state_digest(self):
+        """ Returns a SHA-1 hex digest of the state from pack_state, equal states have equal digests.
+        """
+        memory, registers, stack, exec_ptr = self.pack_state()
+
+        digest = hashlib.sha1(memory)
+        digest.update(registers)
+        digest.update(stack)
+        digest.update(str(exec_ptr))
+
+        return digest.hexdigest()
+
+    def decode(self, address):
+        """ Decodes the instruction at address into a record of its handler, the address of the next instruction and its
+        operands. Register operands are stored as the inverse of the register index (~index) while literals are stored
+        as is, so handlers never have to re-validate or re-check for registers. The record is cached until the memory it
+        was decoded from is written to. An address with a native routine registered decodes to a call of that routine
+        and one with a breakpoint to a trap wrapped around the record. Backward jumps decode to handlers that sample the
+        loop detector while one is set and the loop headers it knows to a wrapper that tells it whenever one is
+        reached. Calls, returns and native routines decode to handlers that tell the profiler while one is set.
+        :param int address: The memory address of the instruction to decode
+        :returns tuple (handler, next_ptr, a, b, c)
+        :raises OverflowError when the address is outside of memory
+        :raises ValueError when the instruction or one of its operands is invalid
+        """
+        if address in self.native_routines:
+            record = (execute_native, address, self.native_routines[address], None, None)
+        else:
+            record = self.decode_instruction(address)
 
-                self.exec_ptr += 4
-            elif instruction == AND:
-                a = self.get_a_param()
-                b = self.get_b_param()
-                c = self.get_c_param()
+        if self.watch_flags is not None and record[0] in WATCHED_HANDLERS:
+            record = (WATCHED_HANDLERS[record[0]],) + record[1:]
 
-                self.instruction_and(a, b, c)
+        if self.loop_detector is not None and record[0] in SAMPLED_HANDLERS:
+            target = record[2] if record[0] is execute_jmp else record[3]
+            if target <= address:
+                record = (SAMPLED_HANDLERS[record[0]],) + record[1:]
 
-                self.exec_ptr += 4
-            elif instruction == OR:
-                a = self.get_a_param()
-                b = self.get_b_param()
-                c = self.get_c_param()
+        if self.profiler is not None and record[0] in PROFILED_HANDLERS:
+            record = (PROFILED_HANDLERS[record[0]],) + record[1:]
 
-                self.instruction_or(a, b, c)
+        if self.loop_detector is not None and address in self.loop_detector.headers:
+            record = (execute_loop_header, address, None, record, None)
 
-                self.exec_ptr += 4
-            elif instruction == NOT:
-                a = self.get_a_param()
-                b = self.get_b_param()
+        if address in self.breakpoints:
+            record = (execute_trap, address, self.breakpoints[address], record, None)
 
-                self.instruction_not(a, b)
+        self._decoded[address] = record
 
-                self.exec_ptr += 3
-            elif instruction == RMEM:
-                a = self.get_a_param()
-                b = self.get_b_param()
+        return record
 
-                self.instruction_rmem(a, b)
+    def decode_fused(self, address):
+        """ Decodes the instruction at address as decode does and fuses it with the ones after it into a single
+        superinstruction when they form one of these sequences, which are what challenge.bin executes most:
 
-                self.exec_ptr += 3
-            elif instruction == WMEM:
-                a = self.get_a_param()
-                b = self.get_b_param()
+            push, push...           one record pushing every value
+            pop, pop...             one record popping into every register
+            eq/gt @a; jt/jf @a      compare and branch on the result
+            add @a; jt/jf @a        add and branch on the result, the decrement loops
+            out c, out c...         every character of a literal string written at once
 
-                self.instruction_wmem(a, b)
+        Only plain instructions are fused, so breakpoints, watched memory, native routines and sampled jumps are left
+        alone. A jump into the middle of a sequence runs whatever is decoded at the address it lands on and a write to
+        any word of a sequence drops the superinstruction.
+        :param int address: The memory address of the first instruction
+        :returns tuple a record for run, a superinstruction record or the record from decode
+        """
+        record = self._decoded[address]
+        if record is None:
+            record = self.decode(address)
+
+        handler = record[0]
+        fused = None
+
+        if handler is execute_push or handler is execute_pop:
+            operands = [record[2]]
+            next_ptr = record[1]
+            while len(operands) < MAX_FUSED_RUN:
+                following = self.decode_following(next_ptr)
+                if following is None or following[0] is not handler:
+                    break
+                operands.append(following[2])
+                next_ptr = following[1]
+
+            if len(operands) > 1:
+                run = execute_push_run if handler is execute_push else execute_pop_run
+                fused = (run, next_ptr, tuple(operands), record)
+        elif handler is execute_out and 0 <= record[2] < 256:
+            characters = [record[2]]
+            next_ptr = record[1]
+            while True:
+                following = self.decode_following(next_ptr)
+                if following is None or following[0] is not execute_out or not 0 <= following[2] < 256:
+                    break
+                characters.append(following[2])
+                next_ptr = following[1]
+
+            if len(characters) > 1:
+                fused = (execute_out_run, next_ptr, str(bytearray(characters)), None, None)
+        elif handler in FUSED_BRANCHES:
+            following = self.decode_following(record[1])
+            if following is not None and following[0] in FUSED_BRANCHES[handler] and following[2] == ~record[2]:
+                fused = (FUSED_BRANCHES[handler][following[0]], following[1], record[2], record[3], record[4],
+                         following[3])
+
+        if fused is None:
+            self._fused[address] = record
+            return record
+
+        owners = self._fusion_owners
+        for word in range(address, fused[1]):
+            owners[word] = owners[word] | frozenset([address])
+
+        self._fused[address] = fused
+        return fused
+
+    def decode_following(self, address):
+        """ The record at address for fusing it onto the one before, None when there isn't a valid instruction there
+        """
+        if address > MAX_MEMORY_ADDRESS:
+            return None
+
+        record = self._decoded[address]
+        if record is None:
+            try:
+                record = self.decode(address)
+            except (ValueError, OverflowError, IndexError):
+                return None
+
+        return record
+
+    def decode_instruction(self, address):
+        """ Decodes the instruction at address as decode does, ignoring native routines and without caching it
+        :param int address: The memory address of the instruction to decode
+        :returns tuple (handler, next_ptr, a, b, c)
+        """
+        memory = self.memory
 
-                self.exec_ptr += 3
-            elif instruction == CALL:
-                a = self.get_a_param()
+        if address > (len(memory) - 1):
+            raise OverflowError("Execution pointer has overran memory: " + str(address))
 
-                self.instruction_call(a)
-            elif instruction == RET:
-                self.instruction_ret()
-            elif instruction == OUT:
-                a = self.get_a_param()
+        instruction = memory[address]
 
-                self.instruction_out(a)
+        if instruction not in DISPATCH_TABLE:
+            raise ValueError("Unknown instruction " + str(instruction))
 
-                self.exec_ptr += 2
-            elif instruction == IN:
-                a = self.get_a_param()
+        handler, operand_kinds = DISPATCH_TABLE[instruction]
 
-                self.instruction_in(a)
+        operands = [None, None, None]
+        for offset, kind in enumerate(operand_kinds):
+            value = memory[address + offset + 1]
+            Vm.validate_value(value)
 
-                self.exec_ptr += 2
-            elif instruction == NOOP:
-                self.exec_ptr += 1
-                continue
+            if kind == OPERAND_REGISTER:
+                if not Vm.is_register(value):
+                    raise ValueError("Expected register value, instead got: " + str(value))
+                value -= REGISTER_0
+            elif kind == OPERAND_VALUE:
+                if Vm.is_register(value):
+                    value = ~(value - REGISTER_0)
             else:
-                raise ValueError("Unknown instruction " + str(instruction))
+                value = Vm.filter_mem_address(value)
 
-        self.publisher.publish('run-end', vm=self)
+            operands[offset] = value
 
-    def load(self, data):
-        """ Takes in parsed binary data and loads it into memory
-        :param data: []
+        return handler, address + len(operand_kinds) + 1, operands[0], operands[1], operands[2]
+
+    def register_native(self, address, routine):
+        """ Run routine instead of the code at address whenever execution reaches it. The routine is called with the vm,
+        its registers and the address and has to leave registers, stack and memory exactly as the code it replaces
+        would, returning the address to continue at. It can return None to have the instruction at address run as
+        usual instead.
+        :param int address: The memory address the routine replaces
+        :param routine: callable(vm, registers, address)
         """
-        if len(data) == 0:
-            raise ValueError("No data to load")
-        elif len(data) > MAX_MEMORY_ADDRESS + 1:
-            raise OverflowError("Not enough memory to load program.")
+        if address < 0 or address > MAX_MEMORY_ADDRESS:
+            raise ValueError("Invalid memory address for a native routine: " + str(address))
 
-        count = (MAX_MEMORY_ADDRESS + 1) - len(data)
+        self.native_routines[address] = routine
+        self.invalidate(address)
 
-        data = [int(n) for n in data]
+    def unregister_native(self, address):
+        if address in self.native_routines:
+            del self.native_routines[address]
+            self.invalidate(address)
 
-        self.halt = False
-        self.memory = data + [0] * count
-        self.registers = [
-            0,
-            0,
-            0,
-            0,
-            0,
-            0,
-            0,
-            0
-        ]
-        self.exec_ptr = 0
+    def native_return(self, address):
+        """ Finish a native routine the way a RET at address would
+        :param int address: The address the native routine was registered at
+        :returns the address to continue at
+        """
+        if len(self.stack) == 0:
+            self.halt = True
+            return address
+
+        value = self.stack_pop()
+
+        if Vm.is_register(value):
+            value = self.get_register(value)
+
+        return Vm.filter_mem_address(value)
+
+    def set_breakpoint(self, address, condition=None):
+        """ Trap into the trap event whenever execution reaches address. The check is built into the decoded record at
+        address, so no other instruction pays for it.
+        :param int address: The memory address to break at
+        :param condition: callable(vm) that has to return True for the breakpoint to trigger, always triggers when None
+        """
+        if address < 0 or address > MAX_MEMORY_ADDRESS:
+            raise ValueError("Invalid memory address for a breakpoint: " + str(address))
+
+        self.breakpoints[address] = condition
+        self.invalidate(address)
+
+    def clear_breakpoint(self, address):
+        if address in self.breakpoints:
+            del self.breakpoints[address]
+            self.invalidate(address)
+
+    def watch(self, start, end, flags):
+        """ Trap into the trap event before an RMEM or WMEM touches memory between start and end. Only while something
+        is watched do RMEM and WMEM decode to handlers that look the address up, one bytearray index per access.
+        :param int start: The first address to watch
+        :param int end: The last address to watch
+        :param int flags: WATCH_READ, WATCH_WRITE or both
+        """
+        if start < 0 or end > MAX_MEMORY_ADDRESS or start > end:
+            raise ValueError("Invalid memory range for a watchpoint: %s...%s" % (start, end))
+
+        if self.watch_flags is None:
+            self.watch_flags = bytearray(MAX_MEMORY_ADDRESS + 1)
+            self.drop_decoded()
+
+        for address in range(start, end + 1):
+            self.watch_flags[address] |= flags
+
+    def unwatch(self, start, end, flags=WATCH_READ | WATCH_WRITE):
+        """ Stop watching memory between start and end, going back to the plain handlers once nothing is watched
+        """
+        if self.watch_flags is None:
+            return
+
+        for address in range(max(start, 0), min(end, MAX_MEMORY_ADDRESS) + 1):
+            self.watch_flags[address] &= ~flags
+
+        if not any(self.watch_flags):
+            self.watch_flags = None
+            self.drop_decoded()
+
+    def trap(self, address, reason):
+        """ Publish the trap event for the instruction at address, which hasn't run yet. Subscribers see the VM as it is
+        right before that instruction and can move the execution pointer. A subscriber that swaps the registers, memory
+        or decoded instructions out, as restoring a snapshot or loading an image does, interrupts the VM so the run
+        loops pick the new ones up instead of carrying on with those they keep in locals.
+        :param int address: The address of the instruction that triggered
+        :param str reason: What triggered
+        :returns the address to continue at, address to run the instruction as usual, None when the trap is deferred
+            and the VM is left at address without running it
+        """
+        self._exec_ptr = address
+
+        if address == self._trap_bypass:
+            self._trap_bypass = None
+            return address
+
+        if self._defer_traps:
+            # run_sliced publishes it once run_until has stopped
+            self._deferred_trap = (address, reason)
+            self._interrupted = True
+            return None
+
+        state = (self._registers, self._memory, self._decoded, self._fused)
+
+        self.publisher.publish('trap', vm=self, address=address, reason=reason)
+
+        if any(before is not after for before, after in
+               zip(state, (self._registers, self._memory, self._decoded, self._fused))):
+            self._interrupted = True
+
+        return self._exec_ptr
+
+    def drop_decoded(self):
+        """ Forget every decoded instruction, for when the way they are decoded changes
+        """
+        self._decoded = self.new_address_cache(len(self._memory) + 1)
+        self._fused = self.new_address_cache(len(self._memory) + 1)
+        self._fusion_owners = AddressCache(default=frozenset())
+
+    def remember_signature(self, signature, spans, matches):
+        """ Keep whether memory holds the code of a routine signature in signature_matches until a word of it is
+        written to, so the code doesn't have to be hashed again on every call
+        :param signature: The signature, any hashable
+        :param list spans: (start, end) of the code it covers, end exclusive
+        :param bool matches: Whether memory holds the code
+        """
+        self.signature_matches[signature] = matches
+
+        owners = self._signature_owners
+        for start, end in spans:
+            for address in xrange(start, end):
+                owners[address] = owners[address] | frozenset([signature])
+
+    def invalidate(self, address):
+        """ Drops any decoded instruction that could have been decoded from the word at address, forgets whether the
+        routine signatures covering it match and tells the listing about the write when one is attached.
+        :param int address: The memory address that was written to
+        """
+        decoded = self._decoded
+        fused = self._fused
+        for offset in range(max(address - 3, 0), address + 1):
+            if decoded[offset] is not None:
+                decoded[offset] = None
+            if fused[offset] is not None:
+                fused[offset] = None
+
+        starts = self._fusion_owners[address]
+        if starts:
+            self._fusion_owners[address] = frozenset()
+            for start in starts:
+                fused[start] = None
+
+        signatures = self._signature_owners[address]
+        if signatures:
+            self._signature_owners[address] = frozenset()
+            for signature in signatures:
+                self.signature_matches.pop(signature, None)
+
+        if self.listing is not None:
+            self.listing.mark(address)
 
     # instruction methods
 
@@ -983,7 +2107,9 @@ class Vm(PublisherAware):
         if Vm.is_register(value):
             value = value = self.get_register(value)
 
-        self.memory[Vm.filter_mem_address(address)] = value
+        address = Vm.filter_mem_address(address)
+        self.memory[address] = value
+        self.invalidate(address)
 
     def instruction_call(self, address):
         """ Push the memory address of the next instruction onto the stack and then jump to address
@@ -1018,21 +2144,48 @@ class Vm(PublisherAware):
         """
         if Vm.is_register(value):
             value = self.get_register(value)
-        sys.stdout.write(chr(value))
+        self.output.write(value)
 
     def instruction_in(self, register):
         """ Accept input from the user, able to read in one character though will accept until newline.
         :param register: Where to store the ASCII value of the first character
+        :raises ValueError if the input provider has nothing to read
         """
-        if len(self.input_buffer) == 0:
-            user_input = raw_input() + '\n'
-            self.input_buffer = deque(user_input)
+        if not self.fill_input_buffer():
+            raise ValueError("Attempted to IN without any input available")
 
         char = self.input_buffer.popleft()
         value = ord(char)
 
         self.set_register(register, value)
 
+    def fill_input_buffer(self):
+        """ Tops an empty input buffer up with the next line from the input provider, flushing output first so any
+        prompt is out before input is read.
+        :returns bool whether there is input to read
+        """
+        if len(self.input_buffer) > 0:
+            return True
+
+        self.output.flush()
+
+        if self.input_provider is None:
+            return False
+
+        line = self.input_provider.read_line()
+        if line is None:
+            return False
+
+        self.input_buffer.extend(line)
+        return True
+
+    def feed_input(self, text):
+        """ Queue text to be read by IN instructions ahead of asking the input provider
+        :param str text: The text to queue, lines need their own newline
+        """
+        self.input_buffer.extend(text)
+        self.waiting_for_input = False
+
     #state modifying methods
 
     def set_register(self, register, value):
@@ -1104,7 +2257,9 @@ class Vm(PublisherAware):
         :param int address: The address to write to
         :param int value: The value to write
         """
-        self.memory[Vm.filter_mem_address(address)] = value
+        address = Vm.filter_mem_address(address)
+        self.memory[address] = value
+        self.invalidate(address)
 
     def read_stack(self, offset):
         """Read the value from the passed in address and return it
@@ -1129,6 +2284,30 @@ class Vm(PublisherAware):
         if 0 > offset > stack_size - 1:
             raise ValueError("Invalid stack offset, must be between 0...%s: %s", (str(len(self.memory)), str(offset)))
 
+    @staticmethod
+    def fork_cache(cache):
+        """ Splits a per address cache into two overlays on top of it, one for each side of a fork. A chain of overlays
+        that has grown to AddressCache.MAX_DEPTH is flattened first, so lookups stay short however often VMs fork.
+        :param cache: A list or AddressCache that neither side writes to afterwards
+        :returns tuple (AddressCache, AddressCache)
+        """
+        default = None
+        if isinstance(cache, AddressCache):
+            default = cache.default
+            if cache.depth >= AddressCache.MAX_DEPTH:
+                cache = cache.flatten()
+
+        return AddressCache(cache, default), AddressCache(cache, default)
+
+    @staticmethod
+    def pack_words(words):
+        """ Packs a sequence of words into a uint16 string, copying the buffer directly when it already is one.
+        :param words: A list, deque, array('H') or Stack of words
+        """
+        if hasattr(words, 'tostring'):
+            return words.tostring()
+        return array('H', words).tostring()
+
     @staticmethod
     def validate_value(value):
         """ Validates that the passed in value is less than MAX_INT if it's not it raises a ValueError
@@ -1156,4 +2335,382 @@ class Vm(PublisherAware):
         if not TOROIDAL_MEMORY and (address < 0 or address > MAX_MEMORY_ADDRESS):
             raise ValueError("Invalid memory address in non-toroidal memory mode. " + str(address))
 
-        return address % (MAX_MEMORY_ADDRESS + 1)
\ No newline at end of file
+        return address % (MAX_MEMORY_ADDRESS + 1)
+
+
+# decoded instruction handlers, each takes the vm, its registers and a record built by Vm.decode and returns the address
+# of the next instruction to execute
+
+def execute_halt(vm, registers, record):
+    vm.halt = True
+    return record[1] - 1
+
+
+def execute_set(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    registers[a] = registers[~b] if b < 0 else b
+    return next_ptr
+
+
+def execute_push(vm, registers, record):
+    _, next_ptr, a, _, _ = record
+    vm.stack.append(registers[~a] if a < 0 else a)
+    return next_ptr
+
+
+def execute_pop(vm, registers, record):
+    _, next_ptr, a, _, _ = record
+    if len(vm.stack) == 0:
+        raise ValueError("Attempted to POP against empty stack")
+    registers[a] = vm.stack.pop()
+    return next_ptr
+
+
+def execute_eq(vm, registers, record):
+    _, next_ptr, a, b, c = record
+    registers[a] = 1 if (registers[~b] if b < 0 else b) == (registers[~c] if c < 0 else c) else 0
+    return next_ptr
+
+
+def execute_gt(vm, registers, record):
+    _, next_ptr, a, b, c = record
+    registers[a] = 1 if (registers[~b] if b < 0 else b) > (registers[~c] if c < 0 else c) else 0
+    return next_ptr
+
+
+def execute_jmp(vm, registers, record):
+    return record[2]
+
+
+def execute_jt(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    if (registers[~a] if a < 0 else a) > 0:
+        return b
+    return next_ptr
+
+
+def execute_jf(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    if (registers[~a] if a < 0 else a) == 0:
+        return b
+    return next_ptr
+
+
+def execute_add(vm, registers, record):
+    _, next_ptr, a, b, c = record
+    registers[a] = ((registers[~b] if b < 0 else b) + (registers[~c] if c < 0 else c)) % MAX_INT
+    return next_ptr
+
+
+def execute_mult(vm, registers, record):
+    _, next_ptr, a, b, c = record
+    registers[a] = ((registers[~b] if b < 0 else b) * (registers[~c] if c < 0 else c)) % MAX_INT
+    return next_ptr
+
+
+def execute_mod(vm, registers, record):
+    _, next_ptr, a, b, c = record
+    registers[a] = ((registers[~b] if b < 0 else b) % (registers[~c] if c < 0 else c)) % MAX_INT
+    return next_ptr
+
+
+def execute_and(vm, registers, record):
+    _, next_ptr, a, b, c = record
+    registers[a] = ((registers[~b] if b < 0 else b) & (registers[~c] if c < 0 else c)) % MAX_INT
+    return next_ptr
+
+
+def execute_or(vm, registers, record):
+    _, next_ptr, a, b, c = record
+    registers[a] = ((registers[~b] if b < 0 else b) | (registers[~c] if c < 0 else c)) % MAX_INT
+    return next_ptr
+
+
+def execute_not(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    registers[a] = ~(registers[~b] if b < 0 else b) % MAX_INT
+    return next_ptr
+
+
+def execute_rmem(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    registers[a] = vm.memory[(registers[~b] if b < 0 else b) % MAX_INT]
+    return next_ptr
+
+
+def execute_wmem(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    address = (registers[~a] if a < 0 else a) % MAX_INT
+    vm.memory[address] = registers[~b] if b < 0 else b
+    vm.invalidate(address)
+    return next_ptr
+
+
+def execute_call(vm, registers, record):
+    _, next_ptr, a, _, _ = record
+    vm.stack.append(next_ptr)
+    return (registers[~a] if a < 0 else a) % MAX_INT
+
+
+def execute_ret(vm, registers, record):
+    if len(vm.stack) == 0:
+        vm.halt = True
+        return record[1] - 1
+
+    address = vm.stack.pop()
+
+    if Vm.is_register(address):
+        address = registers[address - REGISTER_0]
+
+    return address % MAX_INT
+
+
+def execute_out(vm, registers, record):
+    _, next_ptr, a, _, _ = record
+    vm.output.write(registers[~a] if a < 0 else a)
+    return next_ptr
+
+
+def execute_in(vm, registers, record):
+    _, next_ptr, a, _, _ = record
+
+    if len(vm.input_buffer) == 0 and not vm.fill_input_buffer():
+        vm.waiting_for_input = True
+        vm.halt = True
+        return next_ptr - 2
+
+    registers[a] = ord(vm.input_buffer.popleft())
+    return next_ptr
+
+
+def execute_noop(vm, registers, record):
+    return record[1]
+
+
+def execute_native(vm, registers, record):
+    _, address, routine, _, _ = record
+    next_ptr = routine(vm, registers, address)
+
+    if next_ptr is None:
+        record = vm.decode_instruction(address)
+        return record[0](vm, registers, record)
+
+    return next_ptr
+
+
+def execute_trap(vm, registers, record):
+    _, address, condition, inner, _ = record
+
+    if condition is None or condition(vm):
+        if vm.trap(address, 'breakpoint') != address:
+            return vm.exec_ptr
+
+        # the subscriber may have swapped the registers out, as loading a snapshot does
+        registers = vm.registers
+        if vm._interrupted:
+            # or the memory the record was decoded from
+            inner = vm.decode_instruction(address)
+
+    return inner[0](vm, registers, inner)
+
+
+def execute_rmem_watched(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    address = (registers[~b] if b < 0 else b) % MAX_INT
+
+    if vm.watch_flags[address] & WATCH_READ:
+        at = next_ptr - 3
+        if vm.trap(at, 'read of %s' % address) != at:
+            return vm.exec_ptr
+        registers = vm.registers
+
+    registers[a] = vm.memory[address]
+    return next_ptr
+
+
+def execute_wmem_watched(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    address = (registers[~a] if a < 0 else a) % MAX_INT
+
+    if vm.watch_flags[address] & WATCH_WRITE:
+        at = next_ptr - 3
+        if vm.trap(at, 'write of %s to %s' % (registers[~b] if b < 0 else b, address)) != at:
+            return vm.exec_ptr
+        registers = vm.registers
+
+    vm.memory[address] = registers[~b] if b < 0 else b
+    vm.invalidate(address)
+    return next_ptr
+
+
+def execute_jmp_sampled(vm, registers, record):
+    vm.loop_detector.back_edge(vm, record[1] - 2, record[2])
+    return record[2]
+
+
+def execute_jt_sampled(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    if (registers[~a] if a < 0 else a) > 0:
+        vm.loop_detector.back_edge(vm, next_ptr - 3, b)
+        return b
+    return next_ptr
+
+
+def execute_jf_sampled(vm, registers, record):
+    _, next_ptr, a, b, _ = record
+    if (registers[~a] if a < 0 else a) == 0:
+        vm.loop_detector.back_edge(vm, next_ptr - 3, b)
+        return b
+    return next_ptr
+
+
+def execute_loop_header(vm, registers, record):
+    _, address, _, inner, _ = record
+    vm.loop_detector.entered(address)
+    return inner[0](vm, registers, inner)
+
+
+def execute_call_profiled(vm, registers, record):
+    target = execute_call(vm, registers, record)
+    vm.profiler.called(target, record[1])
+    return target
+
+
+def execute_ret_profiled(vm, registers, record):
+    next_ptr = execute_ret(vm, registers, record)
+    vm.profiler.returned()
+    return next_ptr
+
+
+def execute_native_profiled(vm, registers, record):
+    next_ptr = execute_native(vm, registers, record)
+    vm.profiler.native_returned(next_ptr)
+    return next_ptr
+
+
+def execute_push_run(vm, registers, record):
+    _, next_ptr, values, _ = record
+    stack = vm.stack
+    for value in values:
+        stack.append(registers[~value] if value < 0 else value)
+    return next_ptr
+
+
+def execute_pop_run(vm, registers, record):
+    _, next_ptr, targets, first = record
+    stack = vm.stack
+    if len(stack) < len(targets):
+        # run them one at a time so an empty stack faults at the right pop
+        return first[0](vm, registers, first)
+    for target in targets:
+        registers[target] = stack.pop()
+    return next_ptr
+
+
+def execute_out_run(vm, registers, record):
+    _, next_ptr, data, _, _ = record
+    vm.output.write_string(data)
+    return next_ptr
+
+
+def execute_eq_jt(vm, registers, record):
+    _, next_ptr, a, b, c, target = record
+    if (registers[~b] if b < 0 else b) == (registers[~c] if c < 0 else c):
+        registers[a] = 1
+        return target
+    registers[a] = 0
+    return next_ptr
+
+
+def execute_eq_jf(vm, registers, record):
+    _, next_ptr, a, b, c, target = record
+    if (registers[~b] if b < 0 else b) == (registers[~c] if c < 0 else c):
+        registers[a] = 1
+        return next_ptr
+    registers[a] = 0
+    return target
+
+
+def execute_gt_jt(vm, registers, record):
+    _, next_ptr, a, b, c, target = record
+    if (registers[~b] if b < 0 else b) > (registers[~c] if c < 0 else c):
+        registers[a] = 1
+        return target
+    registers[a] = 0
+    return next_ptr
+
+
+def execute_gt_jf(vm, registers, record):
+    _, next_ptr, a, b, c, target = record
+    if (registers[~b] if b < 0 else b) > (registers[~c] if c < 0 else c):
+        registers[a] = 1
+        return next_ptr
+    registers[a] = 0
+    return target
+
+
+def execute_add_jt(vm, registers, record):
+    _, next_ptr, a, b, c, target = record
+    value = ((registers[~b] if b < 0 else b) + (registers[~c] if c < 0 else c)) % MAX_INT
+    registers[a] = value
+    return target if value > 0 else next_ptr
+
+
+def execute_add_jf(vm, registers, record):
+    _, next_ptr, a, b, c, target = record
+    value = ((registers[~b] if b < 0 else b) + (registers[~c] if c < 0 else c)) % MAX_INT
+    registers[a] = value
+    return target if value == 0 else next_ptr
+
+
+DISPATCH_TABLE = {
+    HALT: (execute_halt, ''),
+    SET: (execute_set, 'rv'),
+    PUSH: (execute_push, 'v'),
+    POP: (execute_pop, 'r'),
+    EQ: (execute_eq, 'rvv'),
+    GT: (execute_gt, 'rvv'),
+    JMP: (execute_jmp, 'a'),
+    JT: (execute_jt, 'va'),
+    JF: (execute_jf, 'va'),
+    ADD: (execute_add, 'rvv'),
+    MULT: (execute_mult, 'rvv'),
+    MOD: (execute_mod, 'rvv'),
+    AND: (execute_and, 'rvv'),
+    OR: (execute_or, 'rvv'),
+    NOT: (execute_not, 'rv'),
+    RMEM: (execute_rmem, 'rv'),
+    WMEM: (execute_wmem, 'vv'),
+    CALL: (execute_call, 'v'),
+    RET: (execute_ret, ''),
+    OUT: (execute_out, 'v'),
+    IN: (execute_in, 'r'),
+    NOOP: (execute_noop, ''),
+}
+
+# the handlers RMEM and WMEM decode to while memory is watched
+WATCHED_HANDLERS = {
+    execute_rmem: execute_rmem_watched,
+    execute_wmem: execute_wmem_watched,
+}
+
+# the handlers backward jumps decode to while loops are detected
+SAMPLED_HANDLERS = {
+    execute_jmp: execute_jmp_sampled,
+    execute_jt: execute_jt_sampled,
+    execute_jf: execute_jf_sampled,
+}
+
+# the handlers calls, returns and native routines decode to while a profiler samples
+PROFILED_HANDLERS = {
+    execute_call: execute_call_profiled,
+    execute_ret: execute_ret_profiled,
+    execute_native: execute_native_profiled,
+}
+
+# superinstructions for an instruction writing a register followed by a jt or jf on that register
+FUSED_BRANCHES = {
+    execute_eq: {execute_jt: execute_eq_jt, execute_jf: execute_eq_jf},
+    execute_gt: {execute_jt: execute_gt_jt, execute_jf: execute_gt_jf},
+    execute_add: {execute_jt: execute_add_jt, execute_jf: execute_add_jf},
+}